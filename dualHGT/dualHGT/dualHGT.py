@@ -1,34 +1,67 @@
 from datetime import datetime
 from pathlib import Path
 from itertools import combinations
+from functools import lru_cache
 from collections import defaultdict
 import plotly.express as px
 import argparse
-from Bio import Phylo, SeqIO
+import csv
+from Bio import Align, SeqIO
+from Bio.Align import substitution_matrices
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 import Bio
-from io import StringIO
+import Bio.Seq
 import subprocess as sp
 import os
 import itertools as it
-import binascii
+import hashlib
 import os.path
+import gzip
+import io
+import zlib
+import struct
+import bisect
+import re
+import sqlite3
+import pickle
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Bio import bgzf
 import multiprocessing as mp
 import tqdm
 import pandas as pd
 import subprocess
 import sys
-from Bio.SeqRecord import SeqRecord
 from matplotlib_venn import venn3
 import numpy as np
 import shutil
 import matplotlib.pyplot as plt
 import ete3
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, NamedTuple
 
 PARAAT = "ParaAT.pl -h %s -a %s -n %s -p %s -o %s -f axt -t -v"
 KAKS = "KaKs -i %s -o %s -m %s"
 ORTHOFINDER = "orthofinder -f %s -t %s -o %s %s"
+ORTHOFINDER_ADD = "orthofinder -b %s -f %s -t %s %s"
 GFFREAD = "gffread -w %s -y %s -F -S -C -g %s %s"
+COMPRESSED_SUFFIXES = (".gz", ".bgz")
+FASTAMOD_BATCH_SIZE = 10000
+KS_BATCH_SIZE = 256
+KAKS_AXT_BATCH_SIZE = 1000
+PAIR_CHUNK_SIZE = 1000000
+MIN_BACKGROUND_PAIRS = 200
+# bumped when a topology engine changes its results, so that the cached comparisons are not reused
+TOPOLOGY_CACHE_VERSION = 2
+# the nucleotides of the codon indices (16 * first + 4 * second + third)
+CODON_BASES = "TCAG"
+
+# the gene table of the gene tree workers (see `init_tree_worker()`)
+GENE_TABLE = None
+# the species tree of the topology workers (see `init_topology_worker()`)
+SPECIES_TREE = None
+# the collection files of the built-in Ks workers (see `init_ks_worker()`)
+KS_SEQUENCES = None
 
 
 def arguments():
@@ -41,15 +74,71 @@ def arguments():
     parser.add_argument('-gff', '--gffread',
                         action='store_true',
                         help="Use this flag if the input files are a .fasta genome with its .gff annotation. Default is .fasta cds.")
+    parser.add_argument('-xgff', '--externalGffread',
+                        action='store_true',
+                        help="In GFF mode, extract the CDS with the gffread executable instead of the built-in extraction.")
     parser.add_argument('-OFr', '--orthofinderResults',
                         type=str,
                         help="The path to a previous OrthoFinder results folder. If not provided, the tool will run Orthofinder.")
+    parser.add_argument('-add', '--addSpecies',
+                        action='store_true',
+                        help="Add the new species of the input directory to the results of a previous run, "
+                             "recomputing only what involves them. The previous OrthoFinder results are taken from "
+                             "`-OFr` or, if not given, from the last run.")
     parser.add_argument('-nt', '--numberThreads',
                         type=int,
-                        help='Number of parallel threads to use')
+                        help='Number of parallel threads to use. Default is the number of CPUs.')
     parser.add_argument('-o', '--output',
                         default="output",
                         help="The name of the output file. Default is a folder named `output`.")
+    parser.add_argument('-sp', '--speciesPairs',
+                        type=str,
+                        help="Restrict the analysis to these species pairs, as comma-separated `species1:species2` "
+                             "(e.g. `spA:spB,spA:spC`). Default is all pairs of different species.")
+    parser.add_argument('-maxog', '--maxOGSize',
+                        type=int,
+                        help="The largest orthogroup (number of genes in its gene tree) analysed in full. "
+                             "Larger orthogroups are reduced with `--largeOGPolicy`. Default is no limit.")
+    parser.add_argument('-ogp', '--largeOGPolicy',
+                        choices=['subsample', 'representative', 'keep'],
+                        default='subsample',
+                        help="How orthogroups larger than `--maxOGSize` are reduced: `subsample` keeps random genes, "
+                             "an equal share per species; `representative` keeps one gene per single-species clade "
+                             "(then subsamples if still too large); `keep` analyses them in full but reports them. "
+                             "Default is `subsample`.")
+    parser.add_argument('-topo', '--topologyEngine',
+                        choices=['bitset', 'ete3'],
+                        default='bitset',
+                        help="How gene tree topologies are compared with the species tree: `bitset` compares the "
+                             "species clusters of the trees as integer bitsets, and also compares multi-copy and "
+                             "unrooted gene trees (as species bipartitions); `ete3` uses ete3 `compare()`, which "
+                             "rejects them. Default is `bitset`.")
+    parser.add_argument('-ks', '--ksEngine',
+                        choices=['NG', 'YN', 'kaks'],
+                        default='kaks',
+                        help="How the Ks of the gene pairs is computed: `NG` (Nei-Gojobori) or `YN` (transition/"
+                             "transversion-weighted counting) with the built-in engine, or `kaks` with ParaAT and "
+                             "KaKs Calculator. Default is `kaks`.")
+    parser.add_argument('-ksq', '--ksPrefilter',
+                        type=float,
+                        help="Only compute the Ks of the gene pairs whose tree distance is below this quantile of "
+                             "their species pair (e.g. `0.1`), plus a background sample of all the pairs "
+                             "(see `--ksBackground`). Default is computing the Ks of every pair.")
+    parser.add_argument('-ksm', '--ksPrefilterMargin',
+                        type=float,
+                        default=0.2,
+                        help="The safety margin of `--ksPrefilter`: the tree distance threshold is raised by this "
+                             "fraction. Default is `0.2`.")
+    parser.add_argument('-ksb', '--ksBackground',
+                        type=float,
+                        default=0.02,
+                        help="With `--ksPrefilter`, the fraction of all the gene pairs whose Ks is computed anyway, "
+                             "from which the Ks thresholds are estimated; each species pair gets at least "
+                             f"{MIN_BACKGROUND_PAIRS} background pairs. Default is `0.02`.")
+    parser.add_argument('-ksc', '--ksCache',
+                        type=str,
+                        help="An sqlite file caching the Ks values by the CDS of the gene pairs and the Ks model, "
+                             "which can be shared between projects. Default is `ks_cache.sqlite` in `input/results`.")
     parser.add_argument('-v', '--verbose',
                         action='store_true')
     parser.add_argument('-e', '--extra',
@@ -57,15 +146,206 @@ def arguments():
                         help='Eventual extra flags and attributes to pass to Orthofinder')
 
     args = parser.parse_args()
+    # the thread count is resolved once, so every step gets an integer
+    args.numberThreads = args.numberThreads or os.cpu_count()
 
     return (args)
 
 
-def prepare_fasta_input(arg):
+def input_suffix(filename):
+    """
+    The format suffix of an input file, ignoring the compression suffix: `genome.fa.gz` -> `.fa`.
+    """
+    suffixes = Path(filename).suffixes
+    if suffixes and suffixes[-1] in COMPRESSED_SUFFIXES:
+        suffixes = suffixes[:-1]
+    return suffixes[-1] if suffixes else ''
+
+
+def strip_compression_suffix(filename):
+    """
+    The input file name without its compression suffix: `genome.fa.gz` -> `genome.fa`.
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def is_gzip(path):
+    with open(path, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(path):
+    """
+    Check if a file is BGZF compressed (bgzip): a gzip file whose first block carries the `BC` extra subfield.
+    """
+    with open(path, "rb") as fh:
+        header = fh.read(16)
+    return len(header) == 16 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+class BgzfParallelReader(io.RawIOBase):
+    """
+    A sequential reader of BGZF (bgzip) files that decompresses the blocks in a pool of threads.
+
+    The blocks are independent deflate streams, and zlib releases the GIL while inflating,
+    so the blocks read ahead are decompressed in parallel and handed out in file order.
+    """
+
+    def __init__(self, path, threads):
+        super().__init__()
+        self._fh = open(path, "rb")
+        self._executor = ThreadPoolExecutor(threads)
+        self._pending = deque()
+        self._window = threads * 4
+        self._buffer = b""
+        self._eof = False
+
+    def _read_block(self):
+        header = self._fh.read(12)
+        if len(header) < 12:
+            return None
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = self._fh.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            si1, si2, slen = extra[i], extra[i + 1], struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if si1 == 66 and si2 == 67:  # 'BC' subfield: total block size - 1
+                bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError(f"{self._fh.name} is not a BGZF file")
+        # the deflate data is followed by CRC32 and ISIZE (8 bytes)
+        data = self._fh.read(bsize + 1 - 12 - xlen)
+        return data[:-8]
+
+    def _fill(self):
+        while not self._eof and len(self._pending) < self._window:
+            block = self._read_block()
+            if block is None:
+                self._eof = True
+                break
+            self._pending.append(self._executor.submit(zlib.decompress, block, -15))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            self._fill()
+            if not self._pending:
+                return 0
+            self._buffer = self._pending.popleft().result()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(cancel_futures=True)
+            self._fh.close()
+        super().close()
+
+
+def open_input(path, threads=1):
+    """
+    Open an input file for reading as text, transparently decompressing gzip and bgzip files.
+    BGZF blocks are decompressed in parallel when more than one thread is available.
+
+    Args:
+        path (str): The path to the (possibly compressed) file.
+        threads (int): The number of threads used to decompress BGZF blocks.
+    Returns:
+        A text file handle.
+    """
+    if threads > 1 and is_bgzf(path):
+        return io.TextIOWrapper(io.BufferedReader(BgzfParallelReader(path, threads), 1 << 20))
+    if is_gzip(path):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+class IndexedGenome:
+    """
+    Random access to the sequences of a (possibly compressed) .fasta genome.
+
+    - an existing samtools `.fai` index is used directly, together with the `.gzi` index for bgzip files;
+    - otherwise the genome is indexed with `SeqIO.index`, which also handles bgzip files;
+    - plain gzip files cannot be accessed randomly and are loaded in memory.
+    """
+
+    def __init__(self, genome_file):
+        self._fai = {}
+        self._records = None
+        self._handle = None
+        self._gzi = None
+
+        fai_file = genome_file + ".fai"
+        gzi_file = genome_file + ".gzi"
+        bgzip = is_bgzf(genome_file)
+
+        if os.path.exists(fai_file) and (not bgzip or os.path.exists(gzi_file)):
+            with open(fai_file, "r") as fh:
+                for line in fh:
+                    name, length, offset, linebases, linewidth = line.split("\t")[:5]
+                    self._fai[name] = (int(length), int(offset), int(linebases), int(linewidth))
+            if bgzip:
+                with open(gzi_file, "rb") as fh:
+                    count = struct.unpack("<Q", fh.read(8))[0]
+                    entries = struct.unpack(f"<{2 * count}Q", fh.read(16 * count))
+                # (uncompressed offset, compressed offset) of every block start, first block implicit
+                self._gzi = [(0, 0)] + [(entries[i + 1], entries[i]) for i in range(0, len(entries), 2)]
+                self._handle = bgzf.BgzfReader(genome_file, "rb")
+            else:
+                self._handle = open(genome_file, "rb")
+        elif bgzip or not is_gzip(genome_file):
+            self._records = SeqIO.index(genome_file, "fasta")
+        else:
+            print(f"Warning: '{genome_file}' is gzip but not bgzip compressed, loading it in memory. "
+                  f"Compress it with `bgzip` (and index it with `samtools faidx`) for random access.")
+            with open_input(genome_file) as fh:
+                self._records = {record.id: record for record in SeqIO.parse(fh, "fasta")}
+
+    def __contains__(self, seqid):
+        return seqid in self._fai if self._records is None else seqid in self._records
+
+    def fetch(self, seqid):
+        """
+        Return the full sequence of `seqid` as an uppercase string.
+        """
+        if self._records is not None:
+            return str(self._records[seqid].seq).upper()
+
+        length, offset, linebases, linewidth = self._fai[seqid]
+        size = (length // linebases) * linewidth + length % linebases
+        if self._gzi is None:
+            self._handle.seek(offset)
+        else:
+            i = bisect.bisect_right(self._gzi, (offset, float("inf"))) - 1
+            uncompressed, compressed = self._gzi[i]
+            self._handle.seek(bgzf.make_virtual_offset(compressed, offset - uncompressed))
+        data = self._handle.read(size)
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode("ascii").upper()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+        if hasattr(self._records, "close"):
+            self._records.close()
+
+
+def prepare_fasta_input(arg, exclude=()):
     """
 
     :param input:
         arg: program parameters
+        exclude: names of species already prepared, to skip (see `add_species()`)
     :return:
     """
 
@@ -86,73 +366,267 @@ def prepare_fasta_input(arg):
         print(f"Error creating directory '{res_path}': {e}")
         raise SystemExit
 
-    gene_association = {}
-    irregular_proteins = []
-
     # Retrieve the .fasta files, containing the CDS sequences, in the input directory
     extensions = ('.fasta', '.faa', '.fa', '.fna', '.fas')
-    fasta_files = [file.name for file in Path(arg.input).iterdir() if file.suffix in extensions]
+    fasta_files = [file.name for file in Path(arg.input).iterdir() if input_suffix(file.name) in extensions]
 
     assert fasta_files, 'Error: No .fasta files found in your input directory. Only .fasta file formats accepted as input.'
 
-    for filename in fasta_files:
+    fasta_files = [filename for filename in fasta_files if filename.split('.')[0] not in exclude]
+
+    # Each species is translated, tagged and written by its own worker
+    jobs = [(arg.input, filename, res_path, decompression_threads(arg, fasta_files)) for filename in fasta_files]
+    species_names = []
+
+    with mp.Pool(species_pool_size(arg, jobs)) as p:
+        for res_name, irregular_count in tqdm.tqdm(p.imap_unordered(prepare_fasta_species, jobs), total=len(jobs),
+                                                   desc="Preparing species..."):
+            species_names.append(res_name)
+            print(f'Warning: found {irregular_count} irregular sequences in {res_name}')
+
+    gene_association_file, irregular_proteins_file = merge_species_tables(res_path, species_names,
+                                                                          append=bool(exclude))
+
+    cds_all_file, prot_all_file = create_collection_file(res_path)
+
+    return (prot_path, prot_all_file, cds_all_file, gene_association_file, irregular_proteins_file)
+
+
+def prepare_fasta_species(job):
+    """
+    Translate, tag and write the CDS sequences of a single species.
 
-        res_name = filename.split('.')[0]
-        res_cds_file = os.path.join(cds_path, f"{res_name}_cds_mod.fas_mod.fasta")
-        res_prot_file = os.path.join(prot_path, f"{res_name}_prot_mod.faa_mod.fasta")
+    Records are handled one at a time, so that memory use does not grow with the size of the proteome.
+    The gene association and irregular protein rows are written to per-species files, merged afterwards by
+    `merge_species_tables()`. This function is executed in parallel with mp.Pool() in `prepare_fasta_input()`.
+
+    Args:
+        job (tuple): The input directory, the name of the CDS .fasta file, the results directory
+            and the number of threads used to decompress the input.
+    Returns:
+        tuple: The species name and the number of irregular sequences found.
+    """
+    input_path, filename, res_path, threads = job
 
-        aa_seqlist = []
-        cds_seqlist = []
+    res_name = filename.split('.')[0]
+    res_cds_file = os.path.join(res_path, 'cds', f"{res_name}_cds_mod.fas_mod.fasta")
+    res_prot_file = os.path.join(res_path, 'prot', f"{res_name}_prot_mod.faa_mod.fasta")
+    gene_association_part, irregular_proteins_part = species_table_files(res_path, res_name)
 
-        for cds_seq in SeqIO.parse(os.path.join(arg.input, filename), "fasta"):
+    irregular_count = 0
+    seen_tags = set()
 
-            species_association = {}
+    with open(res_prot_file, "w") as Ffileaa, open(res_cds_file, "w") as Ffilecds, \
+            open(gene_association_part, "w") as GeneAssociationFile, \
+            open(irregular_proteins_part, "w") as IrregularProteins, \
+            open_input(os.path.join(input_path, filename), threads) as Finput:
+        for cds_seq in SeqIO.parse(Finput, "fasta"):
 
             if cds_seq.seq[0:3] != 'ATG':  # Check if the sequence starts with the canonical start codon
                 # if not, add it to the list of irregular proteins
-                irregular_proteins.append(str(cds_seq.id))
-
-            # Create and assign a unique gene tag to the entry, to avoid ambiguity
-            random_code = binascii.hexlify(os.urandom(10)).decode('utf8')
+                IrregularProteins.write(str(cds_seq.id) + '\n')
+                irregular_count += 1
+
+            # Create and assign a unique gene tag to the entry, to avoid ambiguity.
+            # The tag only depends on the species and the gene ID, so it is the same in every run.
+            random_code = gene_tag(res_name, cds_seq.id)
+            duplicate = 1
+            while random_code in seen_tags:  # the same ID appearing twice in one file
+                random_code = gene_tag(res_name, f"{cds_seq.id}#{duplicate}")
+                duplicate += 1
+            seen_tags.add(random_code)
             random_name = f"gene_{random_code}"
 
             # Translate the CDS into a protein sequence
             aa_seq = cds_seq.translate(id=random_name, description='', to_stop=True)
 
-            # Save the gene tag and the original gene name in a dictionary
-            species_association['id'] = cds_seq.id
-            species_association['species'] = res_name
+            # Save the gene tag and the original gene name, writing like: random_code - original id - species
+            GeneAssociationFile.write(f"{random_code}\t{cds_seq.id}\t{res_name}\n")
             cds_seq.id = random_name
             cds_seq.description = ''
 
-            # Append to the seqlist files
-            aa_seqlist.append(aa_seq)
-            cds_seqlist.append(cds_seq)
+            # Save the protein and CDS sequences in the respective folders
+            Ffileaa.write(aa_seq.format("fasta"))
+            Ffilecds.write(cds_seq.format("fasta"))
 
-            gene_association[random_code] = species_association  # TODO check if this is correct...
+    return res_name, irregular_count
 
-        print(f'Warning: found {len(irregular_proteins)}')
 
-        # Save the protein and CDS sequences in the respective folders
-        with open(res_prot_file, "w") as Ffileaa:
-            SeqIO.write(aa_seqlist, Ffileaa, "fasta")
-        with open(res_cds_file, "w") as Ffilecds:
-            SeqIO.write(cds_seqlist, Ffilecds, "fasta")
+def gene_tag(species, gene_id):
+    """
+    Compute the tag of a gene from its species and its original ID.
 
-    gene_association_file, irregular_proteins_file = create_g_ass_and_irr_prot_files(res_path, irregular_proteins,
-                                                                                     gene_association)
-    cds_all_file, prot_all_file = create_collection_file(res_path)
+    The tag is a hash of the two, so a gene keeps the same name across runs and machines
+    and the downstream results (OrthoFinder, alignments, .kaks files) can be reused.
+
+    Args:
+        species (str): The species name.
+        gene_id (str): The original gene ID.
+    Returns:
+        str: A 20 characters hexadecimal tag.
+    """
+    return hashlib.blake2b(f"{species}\t{gene_id}".encode("utf8"), digest_size=10).hexdigest()
 
-    return (prot_path, prot_all_file, cds_all_file, gene_association_file, irregular_proteins_file)
 
+def species_pool_size(arg, jobs):
+    """
+    The number of workers used to prepare the species in parallel: one per species, up to `-nt`.
+    """
+    return max(1, min(arg.numberThreads, len(jobs)))
+
+
+def decompression_threads(arg, jobs):
+    """
+    The number of threads each species worker can use to decompress its inputs: the threads left over by the pool.
+    """
+    return max(1, arg.numberThreads // species_pool_size(arg, jobs))
+
+
+def species_table_files(res_path, res_name):
+    """
+    The paths of the per-species gene association and irregular protein files written by the preparation workers.
+    """
+    return (os.path.join(res_path, f"{res_name}_gene_association.part"),
+            os.path.join(res_path, f"{res_name}_irregular_proteins.part"))
+
+
+def merge_species_tables(res_path, species_names, append=False):
+    """
+    Merge the per-species gene association and irregular protein files into the final
+    `gene_association.txt` and `irregular_proteins.txt`, removing the partial files.
+
+    Args:
+        res_path (str): The path to the results directory.
+        species_names (list): The names of the species prepared by the workers.
+        append (bool): Append to the files of a previous run instead of overwriting them,
+            so that the genes already there keep their row (their integer ID in the gene table).
+    Returns:
+        tuple: The paths to the gene association file and to the irregular proteins file.
+    """
+    gene_association_file = os.path.join(res_path, "gene_association.txt")
+    irregular_proteins_file = os.path.join(res_path, "irregular_proteins.txt")
+
+    # species are merged in a fixed order, so that the output does not depend on which worker finished first
+    mode = "a" if append else "w"
+    with open(gene_association_file, mode) as GeneAssociationFile, \
+            open(irregular_proteins_file, mode) as IrregularProteins:
+        for res_name in sorted(species_names):
+            gene_association_part, irregular_proteins_part = species_table_files(res_path, res_name)
+            for part, out in ((gene_association_part, GeneAssociationFile),
+                              (irregular_proteins_part, IrregularProteins)):
+                with open(part, "r") as fh:
+                    shutil.copyfileobj(fh, out)
+                os.remove(part)
+
+    return gene_association_file, irregular_proteins_file
+
+
+class GeneTable(NamedTuple):
+    """
+    The gene association as a columnar table, where the integer ID of a gene is its row number.
+
+    `tags` (the 20 characters gene tags), `species` (int16 codes, indexes of `species_names`)
+    and `ids` (the original gene IDs) are memory-mapped from `gene_table.npy`;
+    `sorted_tags` and `order` are used by `gene_ids()` to turn gene names into integer IDs.
+    """
+    tags: np.ndarray
+    species: np.ndarray
+    ids: np.ndarray
+    species_names: list
+    sorted_tags: np.ndarray
+    order: np.ndarray
+
+
+def write_gene_table(res_path):
+    """
+    Convert `gene_association.txt` into the columnar `gene_table.npy` (tag, species code, original ID)
+    and `gene_table_species.txt` (the species names, one per code). The row order is the one of the
+    gene association file, and the row number is the integer ID of the gene in the whole pipeline.
+
+    Args:
+        res_path (str): The path to the results directory.
+    Returns:
+        str: The path to the gene table.
+    """
+    gene_association = pd.read_csv(os.path.join(res_path, "gene_association.txt"), sep="\t", header=None,
+                                   names=["tag", "id", "species"], dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False)
+    species_names = sorted(gene_association["species"].unique())
+    ids = gene_association["id"].str.strip().str.encode("utf8")
+
+    table = np.zeros(len(gene_association), dtype=[("tag", "S20"),
+                                                   ("species", "<i2"),
+                                                   ("id", f"S{max(ids.str.len().max(), 1) if len(ids) else 1}")])
+    table["tag"] = gene_association["tag"].str.encode("ascii")
+    # species codes follow the alphabetical order of the names, so comparing codes is comparing names
+    table["species"] = pd.Categorical(gene_association["species"], categories=species_names).codes
+    table["id"] = ids
+
+    gene_table_file = os.path.join(res_path, "gene_table.npy")
+    np.save(gene_table_file, table)
+    with open(os.path.join(res_path, "gene_table_species.txt"), "w") as fh:
+        fh.write("".join(f"{name}\n" for name in species_names))
+
+    return gene_table_file
+
+
+def load_gene_table(res_path):
+    """
+    Load the gene table written by `write_gene_table()`, memory-mapping its columns.
+
+    Returns:
+        GeneTable: The gene table.
+    """
+    table = np.load(os.path.join(res_path, "gene_table.npy"), mmap_mode="r")
+    with open(os.path.join(res_path, "gene_table_species.txt"), "r") as fh:
+        species_names = [line.rstrip("\n") for line in fh]
+
+    tags = table["tag"]
+    order = np.argsort(tags, kind="stable").astype(np.int32)
+
+    return GeneTable(tags, table["species"], table["id"], species_names, tags[order], order)
+
+
+def gene_ids(gene_table, names):
+    """
+    Turn gene names into integer gene IDs with a vectorized lookup of their tags.
 
-def prepare_gff_input(arg):
+    Args:
+        gene_table (GeneTable): The gene table.
+        names (iterable): Gene names ending with their tag: `gene_<tag>`,
+            or the `<species>_gene_<tag>` leaf names of the gene trees.
+    Returns:
+        np.ndarray: The int32 gene IDs, -1 for the names missing from the table.
+    """
+    tags = np.array(pd.Series(list(names), dtype=object).str[-20:].tolist(), dtype="S20")
+    if not len(gene_table.sorted_tags):
+        return np.full(len(tags), -1, dtype=np.int32)
+
+    position = np.searchsorted(gene_table.sorted_tags, tags).clip(max=len(gene_table.sorted_tags) - 1)
+    found = gene_table.sorted_tags[position] == tags
+
+    return np.where(found, gene_table.order[position], -1).astype(np.int32)
+
+
+def gene_names(gene_table, ids):
+    """
+    Turn integer gene IDs back into readable names: `<species>_<original ID>`.
+    For GFF annotations, only the `ID=` attribute of the original feature is kept.
+    """
+    ids = np.asarray(ids)
+    species = pd.Series(np.asarray(gene_table.species_names, dtype=object)[gene_table.species[ids]])
+    original = pd.Series(gene_table.ids[ids]).str.decode("utf8").str.split("ID=").str[-1].str.split(";").str[0]
+
+    return (species + "_" + original).to_numpy()
+
+
+def prepare_gff_input(arg, exclude=()):
     """
     Reads GFF files, modifies them, and performs file operations.
 
     Parameters:
     -----------
         path (str): The path to the directory containing GFF and FASTA files from the species of interest.
+        exclude (tuple): The names of species already prepared, to skip (see `add_species()`).
 
     Returns:
     --------
@@ -164,15 +638,19 @@ def prepare_gff_input(arg):
     cds_path = os.path.join(res_path, "cds")
     input_folder = Path(arg.input)
 
-    # parse the gff files. this function also adds the TAG ... and modifies the gff into .gff_mod_gff
-
-    gene_association = parse_gff(input_folder)
+    if arg.externalGffread:
+        # parse the gff files. this function also adds the TAG ... and modifies the gff into .gff_mod_gff
+        gene_association = parse_gff(input_folder)
+        gff_extensions = [".gff_mod_gff", ".gff3_mod_gff", ".gtf_mod_gff"]
+    else:
+        # the built-in extraction tags the genes itself, so the annotations are read as they are
+        gff_extensions = [".gff", ".gff3", ".gtf"]
 
-    # pick the modified gff files and the fasta files from the input folder.
+    # pick the gff files and the fasta files from the input folder.
     # (These must be the .fasta genome and the .gff annotation files)
 
-    extensions = [".fna", ".fasta", ".gff_mod_gff", ".gff3_mod_gff", ".gtf_mod_gff"]
-    filename = [file.name for file in input_folder.iterdir() if file.suffix in extensions]
+    extensions = [".fna", ".fasta"] + gff_extensions
+    filename = [file.name for file in input_folder.iterdir() if input_suffix(file.name) in extensions]
 
     assert (len(filename) % 2) == 0, f"Error: expected 2 files per species, got {len(filename)} \n\tCheck your input?"
 
@@ -189,21 +667,21 @@ def prepare_gff_input(arg):
         print(f"Error creating directory '{res_path}': {e}")
         raise SystemExit
 
-    # by filtering the data trough dictionary key we can run only 1 for cycle to create
+    # by filtering the data trough dictionary key we can run only 1 for cycle to create 
     # a nested list of file with the same name by using as a key the file name without extension
 
     file_dic = defaultdict(list)
     for file_name in filename:
         name = file_name.split(".")[0]
         file_dic[name].append(file_name)
-    file_matched = [match for match in file_dic.values() if len(match) > 1]
+    file_matched = [match for name, match in file_dic.items() if len(match) > 1 and name not in exclude]
     # we created a nested list with NOT sorted file that are matched
 
     for check in file_matched:
         assert len(check) == 2, f"Error: expected 2 files for species {check}, got {len(check)}. Check your input."
 
-    # here the gffread run will create *.faa_mod.fasta and *.fas_mod.fasta files in the `prot` and `cds` folders
-    gene_association_file, irregular_proteins_file = run_gffread(arg, file_matched)
+    # here the CDS extraction will create *.faa_mod.fasta and *.fas_mod.fasta files in the `prot` and `cds` folders
+    gene_association_file, irregular_proteins_file = run_gffread(arg, file_matched, append=bool(exclude))
 
     # Make a collection .fasta of all prot sequences and another .fasta with all cds sequences
     cds_all_file, prot_all_file = create_collection_file(res_path)
@@ -217,172 +695,431 @@ def prepare_gff_input(arg):
 
 
 def create_collection_file(res_path):
+    """
+    Collect the sequences of all species in two indexed .fasta files:
+    `proteinfilefinal.faa` with all the aminoacid sequences and `cdsfilefinal.fas` with all the coding DNA sequences.
+    See `write_collection_file()`.
+    """
     prot_path = os.path.join(res_path, "prot")
     cds_path = os.path.join(res_path, "cds")
 
     prot_all_file = res_path + '/proteinfilefinal.faa'
     cds_all_file = res_path + '/cdsfilefinal.fas'
 
-    # Dump all sequences into prot_all_file and
-    cmd = 'cat ' + prot_path + '/*.faa_mod.fasta' + ' > ' + prot_all_file  # this .fasta file is a collection of all the aminoacid sequences
-    subprocess.run(cmd, shell=True)
-    cmd = 'cat ' + cds_path + '/*.fas_mod.fasta' + ' > ' + cds_all_file  # this .fasta file is a collection of all the coding DNA sequences
-    subprocess.run(cmd, shell=True)
+    write_collection_file(sorted(Path(prot_path).glob('*.faa_mod.fasta')), prot_all_file)
+    write_collection_file(sorted(Path(cds_path).glob('*.fas_mod.fasta')), cds_all_file)
 
     return cds_all_file, prot_all_file
 
 
-def pool_fastamod(pair: Tuple[Bio.SeqIO.SeqRecord, Bio.SeqIO.SeqRecord]) -> Tuple[
-    SeqRecord, SeqRecord, Dict, bool, str]:  # parallelized function to modify the fasta files.
+def write_collection_file(fasta_files, collection_file):
+    """
+    Concatenate .fasta files into a collection file, writing every sequence on a single line,
+    and index it with a samtools-compatible `.fai` file (name, length, offset, line bases, line width).
+    Any sequence can then be read with a single seek (see `fetch_sequences()`).
 
-    irregular = False
-    gene_association = {}
-    aa, cds = pair
+    Args:
+        fasta_files (list): The paths to the .fasta files to collect.
+        collection_file (str): The path to the collection file to write.
+    """
+    with open(collection_file, "wb") as out, open(collection_file + ".fai", "w") as fai:
+        offset = 0
+        for fasta_file in fasta_files:
+            with open(fasta_file, "r") as fh:
+                for title, seq in SimpleFastaParser(fh):
+                    name = title.split()[0]
+                    header = f">{name}\n".encode()
+                    offset += len(header)
+                    fai.write(f"{name}\t{len(seq)}\t{offset}\t{len(seq)}\t{len(seq) + 1}\n")
+                    out.write(header + seq.encode() + b"\n")
+                    offset += len(seq) + 1
+
+
+def load_fasta_index(collection_file):
+    """
+    Read the `.fai` index of a collection file.
 
-    try:
-        random_name = aa.description.split("HGT=")[1]
-    except IndexError:
-        # print(
-        #    f"Error: Protein (ID = {aa.id}) has no HGT tag in the description. \nAssigning a random gene tag.")
-        random_code = binascii.hexlify(os.urandom(10)).decode("utf8")
-        random_name = f"gene_{random_code}"
-    else:
-        if ";" in random_name:
-            random_name = random_name.split(";")[0]
-        random_code = random_name.split("_")[-1]
+    Returns:
+        dict: The sequence names mapped to their (offset, length) in the collection file.
+    """
+    index = {}
+    with open(collection_file + ".fai", "r") as fh:
+        for line in fh:
+            name, length, offset = line.split("\t")[:3]
+            index[name] = (int(offset), int(length))
+    return index
+
+
+def fetch_sequences(collection_file, names, index=None):
+    """
+    Read a set of sequences from a collection file written by `write_collection_file()`,
+    seeking directly to each of them instead of parsing the whole file.
+
+    Args:
+        collection_file (str): The path to the collection file.
+        names (iterable): The names of the sequences to read.
+        index (dict): The index returned by `load_fasta_index()`, loaded if not given.
+    Returns:
+        dict: The sequences mapped to their names. Names missing from the collection are skipped.
+    """
+    if index is None:
+        index = load_fasta_index(collection_file)
+
+    sequences = {}
+    with open(collection_file, "rb") as fh:
+        # reading in file order keeps the disk access sequential
+        for offset, length, name in sorted((*index[name], name) for name in set(names) if name in index):
+            fh.seek(offset)
+            sequences[name] = fh.read(length).decode()
+    return sequences
 
-    gene_association['id'] = aa.id
 
-    aa.id = random_name
-    cds.id = random_name
-    aa.description = ''
-    cds.description = ''
+def pool_fastamod(batch: List[Tuple[str, str, str]], species: str = '') -> List[Tuple[str, str, bool]]:
+    """
+    Tag a batch of protein records written by gffread.
+
+    The tag is read from the `HGT=` attribute that `parse_gff()` added to the annotation;
+    records without it get a new tag from `gene_tag()`. Only plain tuples go in and out of this function,
+    so batches can be handled (or sent to other processes) without building `SeqRecord` objects.
+
+    Args:
+        batch (list): (id, description, sequence) tuples of the protein records.
+        species (str): The species name, used for records without a tag.
+    Returns:
+        list: An (original id, tag, irregular) tuple for each record, in the same order.
+            `irregular` flags the proteins that do not start with a methionine.
+    """
+    tags = []
+
+    for aa_id, aa_description, aa_seq in batch:
+        try:
+            random_name = aa_description.split("HGT=")[1]
+        except IndexError:
+            # print(
+            #    f"Error: Protein (ID = {aa_id}) has no HGT tag in the description. \nAssigning a new gene tag.")
+            random_code = gene_tag(species, aa_id)
+        else:
+            if ";" in random_name:
+                random_name = random_name.split(";")[0]
+            random_code = random_name.split()[0].split("_")[-1]
+
+        tags.append((aa_id, random_code, not aa_seq.startswith('M')))
 
-    if not aa.seq.startswith('M'):
-        irregular = True  # a flag to collect all irregular proteins
-    return aa, cds, gene_association, irregular, random_code
+    return tags
 
 
-def run_gffread(arg, file_matched):
+def run_gffread(arg, file_matched, append=False):
     """
-    Run and parse the output of GFFREAD for each species' gff-fasta pair.
+    Extract the CDS and protein sequences of each species' gff-fasta pair.
+    Every species is handled by its own worker: `extract_species()` with the built-in extraction,
+    or `gffread_species()` when GFFREAD is requested with `--externalGffread`.
 
     Args:
         arg (object): The argument object containing input and other parameters.
         file_matched (list): The list of matched file names.
+        append (bool): Append the new genes to the gene association of a previous run.
 
     Returns:
-        tuple: A tuple containing the gene association dictionary and a list of irregular proteins.
+        tuple: The paths to the gene association file and to the irregular proteins file.
 
     Raises:
         FileNotFoundError: If the input files are not found.
 
     """
     res_path = os.path.join(arg.input, "results")
+    jobs = [(arg, x, decompression_threads(arg, file_matched)) for x in file_matched]
+    worker = gffread_species if arg.externalGffread else extract_species
+    species_names = []
+
+    with mp.Pool(species_pool_size(arg, jobs)) as p:
+        for res_name, skipped in tqdm.tqdm(p.imap_unordered(worker, jobs), total=len(jobs),
+                                           desc="Extracting CDS of each species..."):
+            species_names.append(res_name)
+            if skipped:
+                print(f"Warning: {len(skipped)} sequences of '{res_name}' could not be extracted and were skipped: "
+                      f"{', '.join(skipped[:10])}{' ...' if len(skipped) > 10 else ''}")
+
+    return merge_species_tables(res_path, species_names, append)
+
+
+def gffread_species(job):
+    """
+    Run GFFREAD on the gff-fasta pair of a single species, then tag and write its CDS and protein sequences.
+    This function is executed in parallel with mp.Pool() in `run_gffread()`.
+
+    Args:
+        job (tuple): The argument object, the list with the two file names of the species
+            and the number of threads used to decompress the input (unused: gffread reads plain files only).
+
+    Returns:
+        tuple: The species name and the list of IDs that could not be paired.
+    """
+    arg, x, threads = job
+    res_path = os.path.join(arg.input, "results")
     prot_path = os.path.join(res_path, "prot")
     cds_path = os.path.join(res_path, "cds")
-    irregular_proteins = []
-    gene_association = {}
 
-    for x in file_matched:
+    gff_f_name = str(next((f_name for f_name in x if f_name.endswith(("_mod_gff"))), None))
+    genome_filename = str(next((f_name for f_name in x if input_suffix(f_name) in (".fna", ".fasta")), None))
+    res_name = str(gff_f_name.split(".")[0])
 
-        gff_f_name = str(next((f_name for f_name in x if f_name.endswith(("_mod_gff"))), None))
-        genome_filename = str(next((f_name for f_name in x if f_name.endswith((".fna", ".fasta"))), None))
-        res_name = str(gff_f_name.split(".")[0])
+    assert not is_gzip(os.path.join(arg.input, genome_filename)), \
+        f"Error: gffread cannot read the compressed genome '{genome_filename}'. Use the built-in extraction instead."
 
-        res_cds_file = os.path.join(cds_path, f"{res_name}_cds_mod.fas")
-        res_prot_file = os.path.join(prot_path, f"{res_name}_prot_mod.faa")
+    res_cds_file = os.path.join(cds_path, f"{res_name}_cds_mod.fas")
+    res_prot_file = os.path.join(prot_path, f"{res_name}_prot_mod.faa")
+    gene_association_part, irregular_proteins_part = species_table_files(res_path, res_name)
 
-        fasta_genome_file = os.path.join(arg.input, genome_filename)
-        gff_file = os.path.join(arg.input, gff_f_name)
+    fasta_genome_file = os.path.join(arg.input, genome_filename)
+    gff_file = os.path.join(arg.input, gff_f_name)
 
-        cmd = GFFREAD % (res_cds_file, res_prot_file, fasta_genome_file, gff_file)
-        # GFFREAD will output the fasta with CDS and protein sequences
+    cmd = GFFREAD % (res_cds_file, res_prot_file, fasta_genome_file, gff_file)
+    # GFFREAD will output the fasta with CDS and protein sequences
 
-        result_cds = subprocess.Popen(cmd,
-                                      shell=True,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE
-                                      )
-        out, err = result_cds.communicate()
-        if arg.verbose:
-            print(out)
-            print(err)
+    result_cds = subprocess.Popen(cmd,
+                                  shell=True,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE
+                                  )
+    out, err = result_cds.communicate()
+    if arg.verbose:
+        print(out)
+        print(err)
 
-        aa_seqlist = []
-        cds_seqlist = []
+    unpaired = []
+
+    # stream of tuples (pairs of matched sequences)
+    iterator = extract_pairs_from_files(res_cds_file, res_prot_file, unpaired)
+
+    # the pairs are tagged in large batches and written as soon as each batch is processed
+    with open((res_prot_file + "_mod.fasta"), "w") as Ffileaa, \
+            open((res_cds_file + "_mod.fasta"), "w") as Ffilecds, \
+            open(gene_association_part, "w") as GeneAssociationFile, \
+            open(irregular_proteins_part, "w") as IrregularProteins:
+        for batch in chunked(iterator, FASTAMOD_BATCH_SIZE):
+            tags = pool_fastamod([aa for aa, cds in batch], species=res_name)
+            for (aa, cds), (original_id, random_code, irregular) in zip(batch, tags):
+                Ffileaa.write(f">gene_{random_code}\n{aa[2]}\n")
+                Ffilecds.write(f">gene_{random_code}\n{cds[2]}\n")
+                # writing like: random_code - original id - species
+                GeneAssociationFile.write(f"{random_code}\t{original_id}\t{res_name}\n")
+                if irregular:
+                    IrregularProteins.write(f"{res_name}_{original_id}\n")
 
-        iterator = extract_pairs_from_files(res_cds_file,
-                                            res_prot_file)  # contains all tuples (pairs of matched sequences)
+    os.remove(res_cds_file)
+    os.remove(res_prot_file)
 
-        with mp.Pool(arg.numberThreads) as p:
-            for x in tqdm.tqdm(p.imap_unordered(pool_fastamod, iterator), total=len(iterator),
-                               desc=f"Processing '{res_prot_file}' and '{res_cds_file}' sequences..."):
-                aa, cds, g_ass, irregular, random_code = x
-                aa_seqlist.append(aa)
-                cds_seqlist.append(cds)
-                g_ass['species'] = res_name
-                gene_association[random_code] = g_ass
-                if irregular:
-                    irregular_proteins.append(
-                        f"{gene_association[random_code]['species']}_{gene_association[random_code]['id']}")
+    return res_name, unpaired
 
-        with open((res_prot_file + "_mod.fasta"), "w") as Ffileaa, open((res_cds_file + "_mod.fasta"), "w") as Ffilecds:
-            SeqIO.write(aa_seqlist, Ffileaa, "fasta")
-            SeqIO.write(cds_seqlist, Ffilecds, "fasta")
 
-        os.remove(res_cds_file)
-        os.remove(res_prot_file)
+def extract_species(job):
+    """
+    Extract, translate, tag and write the CDS of a single species with the built-in GFF parser
+    (see `extract_cds_from_gff()`), without intermediate files.
+    This function is executed in parallel with mp.Pool() in `run_gffread()`.
 
-    gene_association_file, irregular_proteins_file = create_g_ass_and_irr_prot_files(res_path, irregular_proteins,
-                                                                                     gene_association)
+    Args:
+        job (tuple): The argument object, the list with the two file names of the species
+            and the number of threads used to decompress the input.
 
-    return gene_association_file, irregular_proteins_file
+    Returns:
+        tuple: The species name and the list of transcript IDs that could not be extracted.
+    """
+    arg, x, threads = job
+    res_path = os.path.join(arg.input, "results")
 
+    gff_f_name = str(next((f_name for f_name in x if input_suffix(f_name) in (".gff", ".gff3", ".gtf")), None))
+    genome_filename = str(next((f_name for f_name in x if input_suffix(f_name) in (".fna", ".fasta")), None))
+    res_name = str(gff_f_name.split(".")[0])
+
+    res_cds_file = os.path.join(res_path, "cds", f"{res_name}_cds_mod.fas_mod.fasta")
+    res_prot_file = os.path.join(res_path, "prot", f"{res_name}_prot_mod.faa_mod.fasta")
+    gene_association_part, irregular_proteins_part = species_table_files(res_path, res_name)
+
+    skipped = []
+    iterator = extract_cds_from_gff(os.path.join(arg.input, gff_f_name),
+                                    os.path.join(arg.input, genome_filename),
+                                    skipped,
+                                    threads)
+
+    with open(res_prot_file, "w") as Ffileaa, open(res_cds_file, "w") as Ffilecds, \
+            open(gene_association_part, "w") as GeneAssociationFile, \
+            open(irregular_proteins_part, "w") as IrregularProteins:
+        for transcript_id, cds_seq in iterator:
+            # the same tag `parse_gff()` gives to the transcript, so both extraction paths name genes alike
+            random_code = gene_tag(res_name, transcript_id)
+            random_name = f"gene_{random_code}"
 
-def create_g_ass_and_irr_prot_files(res_path, irregular_proteins, gene_association):
-    gene_association_file = os.path.join(res_path, "gene_association.txt")
+            # translate like `gffread -y -S`: the stop codons are kept and written as '*'
+            aa_seq = Bio.Seq.translate(cds_seq[:len(cds_seq) - len(cds_seq) % 3], stop_symbol='*')
 
-    with open(gene_association_file, "w") as GeneAssociationFile:
-        for k, v in gene_association.items():
+            Ffileaa.write(f">{random_name}\n{aa_seq}\n")
+            Ffilecds.write(f">{random_name}\n{cds_seq}\n")
             # writing like: random_code - original id - species
-            GeneAssociationFile.write(str(k) + '\t' + str(v['id']) + '\t' + str(v['species']) + '\n')
+            GeneAssociationFile.write(f"{random_code}\t{transcript_id}\t{res_name}\n")
+            if not aa_seq.startswith('M'):
+                IrregularProteins.write(f"{res_name}_{transcript_id}\n")
 
-    irregular_proteins_file = os.path.join(res_path, "irregular_proteins.txt")
+    return res_name, skipped
 
-    with open(irregular_proteins_file, "w") as IrregularProteins:
-        IrregularProteins.write("\n".join(irregular_proteins))
 
-    return gene_association_file, irregular_proteins_file
+def extract_cds_from_gff(gff_file, genome_file, skipped=None, threads=1):
+    """
+    Extract the spliced CDS of every transcript of a GFF3/GTF annotation, the way `gffread -C` does.
 
+    The CDS features are grouped by transcript (`Parent` in GFF3, `transcript_id` in GTF).
+    The genome is accessed through an index (see `IndexedGenome`), and only one sequence
+    (chromosome/contig) at a time is loaded in memory. Both files can be gzip or bgzip compressed.
+    Segments are joined in genomic order, reverse complemented on the minus strand, and the
+    phase of the first segment (in transcript orientation) is trimmed from the 5' end.
 
-def extract_pairs_from_files(res_cds_file, res_prot_file):
-    iterator = []
+    Args:
+        gff_file (str): The path to the GFF3/GTF annotation.
+        genome_file (str): The path to the .fasta genome.
+        skipped (list): Optional list collecting the transcripts whose sequence is missing from the genome.
+        threads (int): The number of threads used to decompress a bgzip annotation.
+
+    Yields:
+        tuple: The transcript ID and its CDS sequence (str, uppercase).
+    """
+    # seqid -> transcript -> list of (start, end, strand, phase)
+    features = defaultdict(dict)
 
-    for aa in SeqIO.parse(res_prot_file, "fasta"):
-        for cds in SeqIO.parse(res_cds_file, "fasta"):
-            if aa.id == cds.id:
-                pair = (aa, cds)
-                iterator.append(pair)
+    with open_input(gff_file, threads) as fh:
+        for line in fh:
+            if line.startswith("##FASTA"):
                 break
-    return iterator
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 9 or fields[2] != "CDS":
+                continue
+            parents = gff_attribute(fields[8], "Parent") or gff_attribute(fields[8], "transcript_id")
+            if parents is None:
+                continue
+            phase = int(fields[7]) if fields[7].isdigit() else 0
+            for transcript in parents.split(","):
+                features[fields[0]].setdefault(transcript, []).append(
+                    (int(fields[3]), int(fields[4]), fields[6], phase))
+
+    genome = IndexedGenome(genome_file)
+
+    try:
+        for seqid, transcripts in features.items():
+            if seqid not in genome:
+                if skipped is not None:
+                    skipped.extend(transcripts)
+                continue
+
+            chromosome = genome.fetch(seqid)
+
+            for transcript, segments in transcripts.items():
+                segments.sort()
+                cds_seq = "".join(chromosome[start - 1:end] for start, end, strand, phase in segments)
+
+                if segments[0][2] == "-":
+                    cds_seq = Bio.Seq.reverse_complement(cds_seq)
+                    phase = segments[-1][3]
+                else:
+                    phase = segments[0][3]
+
+                yield transcript, cds_seq[phase:]
+    finally:
+        genome.close()
+
+
+def extract_pairs_from_files(res_cds_file, res_prot_file, unpaired=None):
+    """
+    Stream the matched (protein, CDS) record pairs produced by gffread for one species.
+
+    The CDS file is indexed once by record ID (`SeqIO.index` keeps only the file offsets in memory),
+    then the protein file is read sequentially and every protein is looked up in the index,
+    so the pairing runs in linear time instead of re-parsing the CDS file for every protein.
+    Records are returned as plain (id, description, sequence) tuples read from the raw file content,
+    without building `SeqRecord` objects.
+
+    Args:
+        res_cds_file (str): The path to the CDS .fasta file written by gffread.
+        res_prot_file (str): The path to the protein .fasta file written by gffread.
+        unpaired (list): Optional list collecting the IDs that could not be paired
+            (proteins without a CDS and CDS without a protein). It is filled once the generator is exhausted.
+
+    Yields:
+        tuple: A matched (aa, cds) pair of (id, description, sequence) tuples.
+    """
+    cds_index = SeqIO.index(res_cds_file, "fasta")
+    paired = set()
+
+    try:
+        with open(res_prot_file, "r") as fh:
+            for title, aa_seq in SimpleFastaParser(fh):
+                aa_id, _, aa_description = title.partition(" ")
+                try:
+                    raw = cds_index.get_raw(aa_id).decode()
+                except KeyError:
+                    if unpaired is not None:
+                        unpaired.append(aa_id)
+                    continue
+                paired.add(aa_id)
+                cds_title, _, cds_seq = raw[1:].partition("\n")
+                cds_description = cds_title.partition(" ")[2].strip()
+                yield (aa_id, aa_description, aa_seq), (aa_id, cds_description, cds_seq.replace("\n", "").strip())
+
+        if unpaired is not None:
+            unpaired.extend(cds_id for cds_id in cds_index if cds_id not in paired)
+    finally:
+        cds_index.close()
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable in lists of at most `size` elements.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(it.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def gff_attribute(attributes, key):
+    """
+    Read an attribute from the 9th column of a GFF3 (`key=value;`) or GTF (`key "value";`) line.
+    Returns None if the attribute is missing.
+    """
+    for field in attributes.strip().split(";"):
+        field = field.strip()
+        if field.startswith(key + "="):
+            return field[len(key) + 1:]
+        if field.startswith(key + " "):
+            return field[len(key) + 1:].strip().strip('"')
+    return None
 
 
 def parse_gff(folder):
     gene_association = {}  # gene_association is a dict used to save the mapping between the tag and the actual gene name
 
     gff = [".gff", ".gff3", ".gtf"]
-    filename_gff = [os.path.join(folder, file.name) for file in folder.iterdir() if file.suffix in gff]
+    filename_gff = [os.path.join(folder, file.name) for file in folder.iterdir() if input_suffix(file.name) in gff]
 
     for file in filename_gff:
-        with open(file + "_mod_gff", "w") as fho:
-            with open(file, "r") as fh:
+        species = os.path.basename(file).split(".")[0]
+        # the modified copy is written uncompressed, for gffread to read it
+        with open(strip_compression_suffix(file) + "_mod_gff", "w") as fho:
+            with open_input(file) as fh:
                 for line in fh:
                     if line.startswith("#"):
                         continue
                     elif len(line.split("\t")) == 9 and line.split("\t")[2].startswith(("mRNA", "CDS")):
-                        random_code = binascii.hexlify(os.urandom(10)).decode('utf8')
-                        genes_collection = [file.rsplit(".", 1)[0].rsplit("/", 1)[1], line.replace("\t", " ").rstrip()]
+                        # the transcript and its CDS lines share the same tag, derived from the transcript ID
+                        feature, attributes = line.split("\t")[2], line.split("\t")[8]
+                        transcript = (gff_attribute(attributes, "ID") if feature.startswith("mRNA")
+                                      else gff_attribute(attributes, "Parent")) \
+                            or gff_attribute(attributes, "transcript_id") \
+                            or line.rstrip()
+                        random_code = gene_tag(species, transcript)
+                        genes_collection = [species, line.replace("\t", " ").rstrip()]
                         line = line.rstrip() + ";HGT=gene_" + str(random_code)
                         fho.write(line + "\n")
                         gene_association[str(random_code)] = genes_collection
@@ -435,116 +1172,600 @@ def run_orthofinder(prot_path, arg):
     return orthofinder_output_folder
 
 
-def getSpNames(ResultsPath):
-    """
-    Retrieve the names of the species from the species tree file, created by OrthoFinder.
-    ## Args:
-        ResultsPath (str): The path to the Orthofinder results folder.
-    ## Returns:
-        list: A list of strings containing the names of the species.
+def run_orthofinder_add(new_prot_path, previous_results_path, arg):
     """
-    with open(ResultsPath + "/Species_Tree/SpeciesTree_rooted.txt", "r") as f:
-        speciesTree = f.read()
-        speciesTree = Phylo.read(StringIO(speciesTree), "newick")
-        speciesNames = [clade.name for clade in speciesTree.get_terminals()]
-
-        # speciesNames è una lista di stringhe con i nomi delle specie
-        return speciesNames
+    Runs OrthoFinder in its add-species mode (`-b`), adding the proteomes of `new_prot_path`
+    to a previous OrthoFinder analysis, and returns the path to the new results folder.
 
+    Args:
+    -----
+        `new_prot_path (str)`: The path to the directory containing the proteome files of the new species only.
+        `previous_results_path (str)`: The path to the previous OrthoFinder results folder.
 
-def read_tree(info):
+    Returns:
+    --------
+        str: The path to the new OrthoFinder results folder.
     """
-    Reads the a genetree file and returns a list containing gene pairs, their orthogroup, and their distance.
+    working_directory = os.path.join(previous_results_path, "WorkingDirectory")
+    assert os.path.exists(working_directory), \
+        f"Error: '{previous_results_path}' has no WorkingDirectory: OrthoFinder cannot add species to it."
 
-    ## Args:
-        info (tuple): A tuple containing the path to the genetree file and the species list.
-    ## Returns:
-        list: A list containing gene pairs and their distances. This list corresponds to a row of the final dataframe used to estimate HGT occurrence.
+    runortho = ORTHOFINDER_ADD % (working_directory,
+                                  new_prot_path,
+                                  str(arg.numberThreads),
+                                  arg.extra)
 
-    This function is called in `parseOrthofinder()` and executed in parallel with mp.Pool()
-    """
+    p1 = sp.Popen(runortho, shell=True)
+    stdout, stderr = p1.communicate()
+    if arg.verbose:
+        print(stdout)
+        print(stderr)
+    if p1.returncode != 0:
+        print(f"OrthoFinder failed: error code {p1.returncode}")
 
-    genetree, species_list = info
-    distances = []
-    genTree = Phylo.read(genetree, "newick")
-    clades = list(genTree.get_terminals())
-    combs = list(it.combinations(clades, 2))
+    # the new results are written somewhere below the previous working directory: take the most recent ones
+    results = [path.parent.parent for path in Path(working_directory).rglob("Orthogroups/Orthogroups.tsv")]
+    assert results, f"Error: no OrthoFinder results found in '{working_directory}'."
 
-    for comb in combs:
+    return str(max(results, key=lambda path: path.stat().st_mtime))
 
-        name1 = comb[0].name
-        name2 = comb[1].name
 
-        if name1 < name2:
-            name1, name2 = name2, name1
+def short_species_name(name):
+    """
+    The species name as given in the input (`spA`), from the name OrthoFinder derives from its proteome file
+    (`spA_prot_mod.faa_mod` in the species tree and in `Orthogroups.tsv`, `spA_prot_mod_faa_mod` in the gene trees).
+    """
+    name = name.replace(".", "_")
+    return name[:-len("_prot_mod_faa_mod")] if name.endswith("_prot_mod_faa_mod") else name
 
-        dist = genTree.distance(name1, name2)
 
-        type = "tree"
+def parse_species_pairs(species_pairs):
+    """
+    Parse the `--speciesPairs` argument into a set of species pairs (frozensets of short species names).
+    Returns None when no restriction is given.
+    """
+    if not species_pairs:
+        return None
+    pairs = set()
+    for pair in species_pairs.split(","):
+        species1, species2 = (short_species_name(name.strip()) for name in pair.split(":"))
+        pairs.add(frozenset((species1, species2)))
+    return pairs
 
-        name1 = f"gene_{name1.split('_')[-1]}"
-        name2 = f"gene_{name2.split('_')[-1]}"
 
-        if name1 < name2:
-            name1, name2 = name2, name1
+def species_pair_mask(species_list, species_pairs=None):
+    """
+    The species pairs for which gene pairs are computed, as a boolean matrix indexed by species code.
 
-        distances.append([name1, name2, genetree.split("/")[-1].split("_")[0], float(dist), type])
-        # the final output is `distances`, a list that looks like this:
-        # [["gene1", "gene2", "dist", "OG", "type"]]
+    Pairs of the same species are never computed; `species_pairs` (see `parse_species_pairs()`) restricts the others.
+    The last row and column stand for leaves of unknown species, which are always kept.
+    """
+    n_species = len(species_list)
+    mask = ~np.eye(n_species + 1, dtype=bool)
+    mask[n_species, n_species] = True
 
-    return distances
+    if species_pairs is not None:
+        names = [short_species_name(name) for name in species_list]
+        for i in range(n_species):
+            for j in range(n_species):
+                mask[i, j] = frozenset((names[i], names[j])) in species_pairs and i != j
 
+    return mask
 
-def parseOrthofinder(ResultsPath: str, threads: int) -> list:
-    """
-    A function to parse the Orthofinder results and return a list of entries containing the gene pairs and their distances.
 
-    ## Args:
-        ResultsPath (str): The path to the Orthofinder results folder.
-        threads (int): The number of threads to use for the parsing.
-    ## Returns:
-        list: Data containing the gene pairs and their distances. The data comes in the form of a list of lists.
-        each list is to be considered as a data entry and will contain these columns:
-            `gene1` | `gene2` | `dist` inferred by OrthoFinder | `OG` | `type` = "tree"
+class GeneTree(NamedTuple):
     """
+    A gene tree parsed once, shared by the distance and the topology stages (see `load_gene_trees()`).
+    Nodes are numbered in preorder: a parent always comes before its children, which keep their order.
+    """
+    parent: np.ndarray  # int32, -1 for the root
+    length: np.ndarray  # float64 branch lengths, 0 when missing
+    names: List[str]  # leaf names, None for internal nodes
 
-    # retrieve the species names from the species tree file
-    species_list = getSpNames(ResultsPath)
-
-    # retrieve the gene trees from the gene trees folder
-    GeneTreesPath = ResultsPath + "/Gene_Trees"
-    for (dir_path, dir_names, file_names) in os.walk(GeneTreesPath):
-        files = file_names
-    tree_abs_path = [(os.path.join(GeneTreesPath, file), species_list) for file in files]
 
-    distances = []
-    # read the gene trees in parallel with multiprocessing.Pool()
-    with mp.Pool(threads) as p:
-        for x in tqdm.tqdm(p.imap_unordered(read_tree, tree_abs_path), total=len(tree_abs_path),
-                           desc="Reading GeneTrees..."):
-            distances.append(x)  # appends each entry to `distances`
-            pass
+# the tokens of a Newick string: brackets, separators, branch lengths, quoted and plain labels, comments
+NEWICK_TOKENS = re.compile(r"\s*(?:([(),;])|:\s*([^,();\[\s]+)|'((?:[^']|'')*)'|\[[^\]]*\]|([^,();:\[\s']+))")
 
-    distances = [item for sublist in distances for item in sublist]  # turn it into a flat list
 
-    return distances
+def parse_newick(newick):
+    """
+    Parse a Newick string (OrthoFinder gene trees and species trees) into a `GeneTree`, without creating an object per node.
 
+    Internal node labels (support values or names such as `n12`) are skipped: only the leaves are named.
 
-def kaksparallel(file: str) -> list:
+    Args:
+        newick (str): The Newick string.
+    Returns:
+        GeneTree: The tree as arrays.
     """
-    Runs the KaKs calculator program in the shell.
+    parent, length, names = [], [], []
+    open_nodes = []  # the internal nodes whose children are being read
+    last = None  # the node the next label or branch length belongs to, None before a new leaf
+
+    def new_node(name):
+        parent.append(open_nodes[-1] if open_nodes else -1)
+        length.append(0.0)
+        names.append(name)
+        return len(parent) - 1
+
+    for token, branch_length, quoted, label in NEWICK_TOKENS.findall(newick):
+        if token == "(":
+            open_nodes.append(new_node(None))
+            last = None
+        elif token == ",":
+            last = None
+        elif token == ")":
+            last = open_nodes.pop()
+        elif token == ";":
+            break
+        elif branch_length:
+            if last is None:  # an unnamed leaf
+                last = new_node("")
+            length[last] = float(branch_length)
+        elif quoted or label:
+            if last is None:
+                last = new_node(quoted.replace("''", "'") if quoted else label)
+
+    return GeneTree(np.array(parent, dtype=np.int32), np.array(length, dtype=np.float64), names)
+
+
+def parse_gene_tree(path):
+    """
+    Parse a Newick gene tree file into a `GeneTree`. Executed in parallel by `load_gene_trees()`.
+    """
+    with open(path, "r") as fh:
+        return parse_newick(fh.read())
 
-    ## Args:
-        file (str): The path to the .axt file to be processed.
-    ## Returns:
-        list_entry: A list containing the seq pair and the calculated Ks value.
 
-    References:
-    -----------
-    Nei, M., & Gojobori, T. (1986). Simple methods for estimating the numbers of synonymous and nonsynonymous nucleotide substitutions. Molecular biology and evolution, 3(5), 418–426. https://doi.org/10.1093/oxfordjournals.molbev.a040410
+def load_gene_trees(ResultsPath, res_path, threads):
     """
+    Read all the gene trees of an OrthoFinder run, parsing each Newick file once.
 
-    # run the 'KAKS' command in the shell
+    The parsed trees are cached in `gene_trees.pkl` in the results directory, with the size and modification time
+    of their files: a rerun only parses the new or modified trees.
+
+    Args:
+        ResultsPath (str): The path to the Orthofinder results folder.
+        res_path (str): The path to the results directory, where the cache is kept.
+        threads (int): The number of processes parsing the trees.
+    Returns:
+        dict: The orthogroup names as keys and their `GeneTree` as values.
+    """
+    GeneTreesPath = os.path.join(ResultsPath, "Gene_Trees")
+    stamps = {entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns)
+              for entry in os.scandir(GeneTreesPath) if entry.is_file()}
+
+    cache_file = os.path.join(res_path, "gene_trees.pkl")
+    cached = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as fh:
+            cache = pickle.load(fh)
+        if cache.get("source") == os.path.abspath(ResultsPath) and cache.get("parser") == "newick":
+            cached = {file: tree for file, (stamp, tree) in cache["trees"].items() if stamps.get(file) == stamp}
+
+    to_parse = sorted(file for file in stamps if file not in cached)
+    if to_parse:
+        with mp.Pool(threads) as p:
+            parsed = list(tqdm.tqdm(p.imap(parse_gene_tree, [os.path.join(GeneTreesPath, file) for file in to_parse],
+                                           chunksize=16),
+                                    total=len(to_parse), desc="Parsing GeneTrees..."))
+        cached.update(zip(to_parse, parsed))
+
+        with open(cache_file, "wb") as fh:
+            pickle.dump({"source": os.path.abspath(ResultsPath), "parser": "newick",
+                         "trees": {file: (stamps[file], tree) for file, tree in cached.items()}},
+                        fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return {file.split("_")[0]: cached[file] for file in sorted(stamps)}
+
+
+def ete3_tree(gene_tree):
+    """
+    Build an `ete3.Tree` from a `GeneTree`, without parsing the Newick file again.
+    """
+    nodes = []
+    for parent_index, length, name in zip(gene_tree.parent, gene_tree.length, gene_tree.names):
+        node = ete3.Tree() if parent_index < 0 else nodes[parent_index].add_child()
+        node.name = name or ""
+        node.dist = float(length)
+        nodes.append(node)
+    return nodes[0]
+
+
+def patristic_distances(parent, length, groups=None, allowed=None):
+    """
+    Compute the patristic distance between all pairs of leaves of a tree in a single bottom-up traversal.
+
+    The distance between two leaves is `depth[a] + depth[b] - 2 * depth[lca]`. Every internal node
+    is the lowest common ancestor of the pairs formed by leaves of two different children, so each pair
+    is produced exactly once, in bulk with NumPy, and the work is bounded by the number of pairs.
+
+    When `groups` and `allowed` are given, only the pairs of leaves whose groups are allowed together are produced
+    (e.g. only the pairs of genes from different species): the others are never materialized.
+
+    Args:
+        parent (np.ndarray): The parent of each node, in preorder (see `GeneTree`).
+        length (np.ndarray): The branch length of each node.
+        groups (np.ndarray): Optional group (species code) of each node.
+        allowed (np.ndarray): Optional boolean matrix, `allowed[g1, g2]` is True if pairs across groups g1 and g2 are kept.
+    Returns:
+        tuple: Three arrays with the node indices of the two leaves of each pair and their distance.
+    """
+    n_nodes = len(parent)
+    depth = np.zeros(n_nodes, dtype=np.float64)
+    for node in range(1, n_nodes):
+        depth[node] = depth[parent[node]] + length[node]
+
+    children = [[] for _ in range(n_nodes)]
+    for node in range(1, n_nodes):
+        children[parent[node]].append(node)
+
+    first, second, dist = [], [], []
+    leaves_below = [None] * n_nodes
+
+    # reverse preorder visits the children before their parent
+    for node in range(n_nodes - 1, -1, -1):
+        if not children[node]:
+            leaves_below[node] = np.array([node], dtype=np.int32)
+            continue
+
+        below = leaves_below[children[node][0]]
+        for child in children[node][1:]:
+            other = leaves_below[child]
+            d = depth[below][:, None] + depth[other][None, :] - 2 * depth[node]
+            if allowed is None:
+                first.append(np.repeat(below, len(other)))
+                second.append(np.tile(other, len(below)))
+                dist.append(d.ravel())
+            else:
+                keep = allowed[groups[below][:, None], groups[other][None, :]]
+                rows, columns = np.nonzero(keep)
+                first.append(below[rows])
+                second.append(other[columns])
+                dist.append(d[keep])
+            below = np.concatenate([below, other])
+        leaves_below[node] = below
+        for child in children[node]:
+            leaves_below[child] = None
+
+    if not first:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+
+    return np.concatenate(first), np.concatenate(second), np.concatenate(dist)
+
+
+def schedule_tasks(costs, threads, batches_per_thread=4):
+    """
+    Group tasks into batches for a process pool, from their estimated cost.
+
+    Tasks are dispatched largest first, so that the longest ones do not start last and keep a single core busy
+    while the others idle. Tasks costing at least `1 / (threads * batches_per_thread)` of the total run alone;
+    the smaller ones are batched together up to that cost, to limit the inter-process overhead.
+
+    Args:
+        costs (np.ndarray): The estimated cost of each task.
+        threads (int): The number of processes of the pool.
+        batches_per_thread (int): The number of batches of average cost per process.
+    Returns:
+        list: Lists of task indices, the costliest batches first.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    target = costs.sum() / max(threads * batches_per_thread, 1)
+
+    batches, batch, batch_cost = [], [], 0.0
+    for index in np.argsort(-costs, kind="stable"):
+        if costs[index] >= target:
+            batches.append([int(index)])
+            continue
+        batch.append(int(index))
+        batch_cost += costs[index]
+        if batch_cost >= target:
+            batches.append(batch)
+            batch, batch_cost = [], 0.0
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def run_timed_batch(task):
+    """
+    Run a function on a batch of items, timing each call. Executed in the pool workers (see `schedule_tasks()`).
+
+    Args:
+        task (tuple): The function, the indices of the items and the list of items.
+    Returns:
+        list: A tuple (index, result, seconds) for each item.
+    """
+    function, indices, items = task
+    results = []
+    for index, item in zip(indices, items):
+        start = time.perf_counter()
+        result = function(item)
+        results.append((index, result, time.perf_counter() - start))
+    return results
+
+
+def write_task_timings(filename, labels, costs, seconds):
+    """
+    Write the estimated cost and the run time of each task in a tsv file, the slowest first, and print the slowest.
+    """
+    timings = pd.DataFrame({"task": labels, "cost": costs, "seconds": seconds})
+    timings = timings.sort_values("seconds", ascending=False)
+    timings.to_csv(filename, sep="\t", index=False)
+    if len(timings):
+        slowest = timings.iloc[0]
+        print(f"\tslowest task: {slowest['task']} ({slowest['seconds']:.2f} s); timings in {filename}")
+
+
+def leaf_gene_ids(gene_tree, gene_table):
+    """
+    The integer gene ID of each node of a gene tree, from the tag at the end of its name (-1 for internal nodes
+    and for genes missing from the gene table).
+    """
+    leaves = np.array([i for i, name in enumerate(gene_tree.names) if name], dtype=np.int32)
+    ids = np.full(len(gene_tree.names), -1, dtype=np.int32)
+    ids[leaves] = gene_ids(gene_table, [gene_tree.names[i] for i in leaves])
+    return ids
+
+
+def subsample_genes(genes, species, max_size, rng):
+    """
+    Keep at most `max_size` genes, an equal share per species, chosen at random.
+    """
+    codes = np.unique(species)
+    share = max(1, max_size // max(len(codes), 1))
+    kept = []
+    for code in codes:
+        members = genes[species == code]
+        kept.append(members if len(members) <= share else rng.choice(members, share, replace=False))
+    return np.sort(np.concatenate(kept)) if kept else genes[:0]
+
+
+def representative_genes(gene_tree, ids, gene_table):
+    """
+    Keep one gene per single-species clade of a gene tree (the in-paralogs): the one closest to the clade root.
+    """
+    parent, length = gene_tree.parent, gene_tree.length
+    n_nodes = len(parent)
+
+    # the species of each subtree: a species code, -1 if it has no known gene, -2 if it mixes species
+    subtree_species = np.full(n_nodes, -1, dtype=np.int32)
+    known = ids >= 0
+    subtree_species[known] = gene_table.species[ids[known]]
+    for node in range(n_nodes - 1, 0, -1):
+        child, up = subtree_species[node], parent[node]
+        if child == -1 or subtree_species[up] == child:
+            continue
+        subtree_species[up] = child if subtree_species[up] == -1 else -2
+
+    # the root of the largest single-species clade containing each node, and the depth of the nodes
+    clade = np.arange(n_nodes, dtype=np.int32)
+    depth = np.zeros(n_nodes, dtype=np.float64)
+    for node in range(1, n_nodes):
+        up = parent[node]
+        depth[node] = depth[up] + length[node]
+        if subtree_species[node] >= 0 and subtree_species[up] == subtree_species[node]:
+            clade[node] = clade[up]
+
+    leaves = np.flatnonzero(known)
+    # the shallowest leaf of each clade
+    order = leaves[np.lexsort((depth[leaves], clade[leaves]))]
+    _, first = np.unique(clade[order], return_index=True)
+    return np.sort(ids[order[first]])
+
+
+def select_large_orthogroups(gene_trees, gene_table, max_size, policy, species_pairs=None):
+    """
+    Apply the large orthogroup policy to the orthogroups whose gene tree has more than `max_size` genes.
+
+    Orthogroups with thousands of members (e.g. transposon-associated and kinase families) produce millions
+    of pairs and dominate runtime and memory, while adding little HGT signal.
+    The genes kept are chosen once and used by both the tree and the Ks stages.
+
+    Args:
+        gene_trees (dict): The gene trees (see `load_gene_trees()`).
+        gene_table (GeneTable): The gene table.
+        max_size (int): The largest orthogroup analysed in full; None to analyse all in full.
+        policy (str): `subsample`, `representative` or `keep` (see `arguments()`).
+        species_pairs (set): The species pairs computed (see `parse_species_pairs()`), the only ones reported.
+            Default is all pairs.
+    Returns:
+        tuple: A dictionary with the orthogroup names as keys and the integer IDs of the genes kept as values
+            (only for the reduced orthogroups), and a report with the genes and pairs dropped per species pair:
+            `OG` | `policy` | `genes` | `kept_genes` | `species` | `pairs` | `kept_pairs` | `dropped_pairs`
+    """
+    kept_genes = {}
+    report = []
+    if not max_size:
+        return kept_genes, pd.DataFrame(report, columns=["OG", "policy", "genes", "kept_genes", "species",
+                                                         "pairs", "kept_pairs", "dropped_pairs"])
+
+    names = gene_table.species_names
+    allowed = species_pair_mask(names, species_pairs)
+    for og, gene_tree in gene_trees.items():
+        ids = leaf_gene_ids(gene_tree, gene_table)
+        genes = ids[ids >= 0]
+        if len(genes) <= max_size:
+            continue
+
+        kept = genes
+        if policy == "representative":
+            kept = representative_genes(gene_tree, ids, gene_table)
+        if policy != "keep" and len(kept) > max_size:
+            # a deterministic choice for each set of members (not the orthogroup name, which OrthoFinder changes
+            # when species are added), so reruns keep the same genes and reused distances match the new pairs
+            members = b"".join(np.sort(gene_table.tags[genes]))
+            rng = np.random.default_rng(int.from_bytes(hashlib.blake2b(members, digest_size=8).digest(), "little"))
+            kept = np.sort(kept)
+            kept = subsample_genes(kept, gene_table.species[kept], max_size, rng)
+        if policy != "keep":
+            kept_genes[og] = kept
+
+        all_counts = np.bincount(gene_table.species[genes], minlength=len(names))
+        kept_counts = np.bincount(gene_table.species[kept], minlength=len(names))
+        for high, low in combinations(np.flatnonzero(all_counts)[::-1], 2):
+            if not allowed[high, low]:
+                continue
+            pairs = int(all_counts[high]) * int(all_counts[low])
+            kept_pairs = int(kept_counts[high]) * int(kept_counts[low])
+            report.append([og, policy, len(genes), len(kept), f"{names[high]}_vs_{names[low]}",
+                           pairs, kept_pairs, pairs - kept_pairs])
+
+    report = pd.DataFrame(report, columns=["OG", "policy", "genes", "kept_genes", "species",
+                                           "pairs", "kept_pairs", "dropped_pairs"])
+    if len(report):
+        print(f"[+] {report['OG'].nunique()} orthogroups larger than {max_size} genes ({policy}): "
+              f"{report['dropped_pairs'].sum()} of {report['pairs'].sum()} gene pairs dropped.")
+    return kept_genes, report
+
+
+def init_tree_worker(res_path):
+    """
+    Load the gene table in each worker of the gene tree pool (memory-mapped, so the pages are shared).
+    """
+    global GENE_TABLE
+    GENE_TABLE = load_gene_table(res_path)
+
+
+def read_tree(info):
+    """
+    Reads the a genetree file and returns the gene pairs of its orthogroup with their distance, as columns.
+
+    ## Args:
+        info (tuple): A tuple containing the parsed genetree (see `GeneTree`), the index of its orthogroup,
+            the species pairs to compute (see `species_pair_mask()`) and the IDs of the genes to keep
+            (None to keep all, see `select_large_orthogroups()`).
+    ## Returns:
+        tuple: The orthogroup index and three arrays: the integer IDs of the two genes of each pair (int32,
+            -1 for genes missing from the gene table) and their distance (float32).
+            Only pairs of genes from different (and selected) species are returned.
+
+    This function is called in `parseOrthofinder()` and executed in parallel with mp.Pool(),
+    whose workers hold the gene table (see `init_tree_worker()`).
+    """
+
+    gene_tree, og_index, allowed, kept = info
+    parent, length, names = gene_tree
+
+    # the gene ID and species of each leaf, from the tag at the end of its name; other nodes get -1
+    ids = leaf_gene_ids(gene_tree, GENE_TABLE)
+
+    # genes of unknown species get the last species code
+    n_species = len(GENE_TABLE.species_names)
+    groups = np.full(len(names), n_species, dtype=np.int32)
+    known = ids >= 0
+    groups[known] = GENE_TABLE.species[ids[known]]
+
+    if kept is not None:
+        # the genes left out of a large orthogroup get an extra group, without any pair
+        allowed = np.pad(allowed, ((0, 1), (0, 1)))
+        groups[known & ~np.isin(ids, kept)] = n_species + 1
+
+    # all the pairwise distances at once, instead of searching the tree for every pair
+    first, second, dist = patristic_distances(parent, length, groups, allowed)
+
+    return og_index, ids[first], ids[second], dist.astype(np.float32)
+
+
+def parseOrthofinder(gene_trees: dict, threads: int, res_path: str, skip=(), species_pairs=None,
+                     kept_genes=None) -> pd.DataFrame:
+    """
+    A function to parse the Orthofinder results and return the gene pairs and their distances.
+
+    ## Args:
+        gene_trees (dict): The gene trees of the Orthofinder results (see `load_gene_trees()`).
+        threads (int): The number of threads to use for the parsing.
+        res_path (str): The path to the results directory, containing the gene table.
+        skip (iterable): Orthogroups whose gene tree is not read (e.g. unchanged since a previous run).
+        species_pairs (set): Only compute these species pairs (see `parse_species_pairs()`). Default is all pairs.
+        kept_genes (dict): The genes kept in the large orthogroups (see `select_large_orthogroups()`).
+    ## Returns:
+        pd.DataFrame: The gene pairs and their distances (see `pairs_frame()`), with these columns:
+            `gene_1` | `gene_2` | `OG` | `dist` inferred by OrthoFinder | `type` = "tree" | `species`
+
+    The workers send back NumPy columns, which are concatenated without creating a Python object per pair.
+    The trees are scheduled by their number of leaves squared (see `schedule_tasks()`) and the time spent on
+    each is written in `tree_task_timings.tsv` in the results directory.
+    """
+
+    gene_table = load_gene_table(res_path)
+
+    skip = set(skip)
+    orthogroups = [og for og in gene_trees if og not in skip]
+
+    allowed = species_pair_mask(gene_table.species_names, species_pairs)
+    kept_genes = kept_genes or {}
+    tree_abs_path = [(gene_trees[og], og_index, allowed, kept_genes.get(og)) for og_index, og in enumerate(orthogroups)]
+
+    # the pairs of a tree grow with the square of its leaves
+    costs = np.array([np.square(sum(1 for name in gene_trees[og].names if name), dtype=np.float64)
+                      for og in orthogroups])
+    batches = schedule_tasks(costs, threads)
+
+    og_chunks, gene1_chunks, gene2_chunks, dist_chunks = [], [], [], []
+    seconds = np.zeros(len(orthogroups))
+    # read the gene trees in parallel with multiprocessing.Pool()
+    with mp.Pool(threads, initializer=init_tree_worker, initargs=(res_path,)) as p:
+        tasks = [(read_tree, batch, [tree_abs_path[index] for index in batch]) for batch in batches]
+        with tqdm.tqdm(total=len(tree_abs_path), desc="Reading GeneTrees...") as pbar:
+            for results in p.imap_unordered(run_timed_batch, tasks):
+                for _, (og_index, gene1, gene2, dist), elapsed in results:
+                    og_chunks.append(np.full(len(dist), og_index, dtype=np.int32))
+                    gene1_chunks.append(gene1)
+                    gene2_chunks.append(gene2)
+                    dist_chunks.append(dist)
+                    seconds[og_index] = elapsed
+                pbar.update(len(results))
+
+    write_task_timings(os.path.join(res_path, "tree_task_timings.tsv"), orthogroups, costs, seconds)
+
+    og = pd.Categorical.from_codes(concat_arrays(og_chunks, np.int32), categories=orthogroups)
+
+    return pairs_frame(concat_arrays(gene1_chunks, np.int32), concat_arrays(gene2_chunks, np.int32), og,
+                       concat_arrays(dist_chunks, np.float32), "tree", gene_table)
+
+
+def write_axt_batches(axt_files, batch_folder, batch_size=KAKS_AXT_BATCH_SIZE):
+    """
+    Pack the single-pair .axt alignments written by ParaAT into multi-pair .axt files,
+    so that KaKs Calculator runs once per batch instead of once per pair.
+
+    Args:
+        axt_files (list): The paths to the .axt files.
+        batch_folder (str): The folder of the batch files.
+        batch_size (int): The number of alignments per batch file.
+    Returns:
+        list: The paths to the batch files.
+    """
+    os.makedirs(batch_folder, exist_ok=True)
+    batches = []
+    for start in range(0, len(axt_files), batch_size):
+        batch_file = os.path.join(batch_folder, f"batch_{start // batch_size:06d}.axt")
+        with open(batch_file, "w") as out:
+            for axt_file in axt_files[start:start + batch_size]:
+                with open(axt_file, "r") as fh:
+                    # an alignment is a name line and the two sequences, followed by a blank line
+                    out.write(fh.read().strip("\n") + "\n\n")
+        batches.append(batch_file)
+    return batches
+
+
+def kaksparallel(file: str) -> list:
+    """
+    Runs the KaKs calculator program in the shell.
+
+    ## Args:
+        file (str): The path to the .axt file to be processed, with one or more alignments (see `write_axt_batches()`).
+    ## Returns:
+        list_entry: A list of entries, each containing a seq pair and the calculated Ks value.
+
+    References:
+    -----------
+    Nei, M., & Gojobori, T. (1986). Simple methods for estimating the numbers of synonymous and nonsynonymous nucleotide substitutions. Molecular biology and evolution, 3(5), 418–426. https://doi.org/10.1093/oxfordjournals.molbev.a040410
+    """
+
+    # run the 'KAKS' command in the shell
     output = file + ".kaks"
     if not os.path.exists(output) or not os.path.getsize(output) > 0:
         runkaks = KAKS % (file,  # the .axt file passed as input
@@ -566,71 +1787,280 @@ def kaksparallel(file: str) -> list:
 
 
 def read_kaks_file(kaks_filename: str) -> list:
+    """
+    Read every row of a KaKs Calculator output file.
+
+    ## Returns:
+        list: A list of [seq pair name, Ks] entries, one per alignment.
+    """
+    list_entry = []
     with open(kaks_filename, newline='') as resultskaks:
-        next(resultskaks)
+        next(resultskaks, None)
         for line in resultskaks:
             if line.strip():
                 # take the first and fourth elements of the file
                 # corresponding to the sequence name and the Ks value
-                list_entry = [line.split('\t')[i] for i in [0, 3]]
+                list_entry.append([line.split('\t')[i] for i in [0, 3]])
     return list_entry
 
 
-def parseKaKs(arg, ResultsPath, proteinfilefinal, cdsfilefinal):
+@lru_cache(maxsize=None)
+def codon_tables():
     """
-    A function to combine the gene pairs from the Orthofinder results and the KaKs distances.
-    ## Args:
-        arg: Program parameters. Duh?
-        ResultsPath (str): The path to the Orthofinder results folder.
-        proteinfilefinal (str): The path to the protein file.
-        cdsfilefinal (str): The path to the CDS file.
-    ## Returns:
-        list: A list containing the gene pairs and their distances. The list will contain this data:
-            `gene1` | `gene2` | `OG` | `dist` = Ks value | `type` = "kaks"
+    Precompute the per-codon tables of the built-in Ks engine, over the 64 codon indices
+    (16 * first + 4 * second + third base, with T, C, A, G = 0, 1, 2, 3).
+
+    Returns:
+        dict: `stop` (bool, the stop codons), `syn_ts` and `syn_tv` (the synonymous transition and
+            transversion neighbors of each codon), `syn_diff` and `nonsyn_diff` (64 x 64, the synonymous
+            and nonsynonymous differences between two codons, averaged over the mutational pathways that avoid
+            stop codons), `ts` and `tv` (64 x 64, the transitions and transversions between two codons).
+    """
+    codons = ["".join(bases) for bases in it.product(CODON_BASES, repeat=3)]
+    amino = [str(Bio.Seq.translate(codon)) for codon in codons]
+    stop = np.array([aa == "*" for aa in amino])
+
+    def is_transition(base1, base2):
+        return {base1, base2} in ({"A", "G"}, {"C", "T"})
+
+    syn_ts = np.zeros(64)
+    syn_tv = np.zeros(64)
+    for i, codon in enumerate(codons):
+        for position in range(3):
+            for base in CODON_BASES:
+                if base == codon[position]:
+                    continue
+                neighbor = codons.index(codon[:position] + base + codon[position + 1:])
+                if amino[neighbor] == amino[i]:  # mutations to stop codons count as nonsynonymous
+                    if is_transition(codon[position], base):
+                        syn_ts[i] += 1
+                    else:
+                        syn_tv[i] += 1
+
+    syn_diff = np.zeros((64, 64))
+    nonsyn_diff = np.zeros((64, 64))
+    ts = np.zeros((64, 64))
+    tv = np.zeros((64, 64))
+    for i, j in it.product(range(64), repeat=2):
+        positions = [p for p in range(3) if codons[i][p] != codons[j][p]]
+        ts[i, j] = sum(is_transition(codons[i][p], codons[j][p]) for p in positions)
+        tv[i, j] = len(positions) - ts[i, j]
+        pathways = []
+        for order in it.permutations(positions):
+            steps, current, through_stop = [], codons[i], False
+            for p in order:
+                following = current[:p] + codons[j][p] + current[p + 1:]
+                steps.append(amino[codons.index(current)] == amino[codons.index(following)])
+                current = following
+                through_stop |= amino[codons.index(current)] == "*" and current != codons[j]
+            pathways.append((steps, through_stop))
+        # the pathways through a stop codon are left out, unless all of them go through one
+        kept = [steps for steps, through_stop in pathways if not through_stop] or [steps for steps, _ in pathways]
+        syn_diff[i, j] = sum(sum(steps) for steps in kept) / len(kept)
+        nonsyn_diff[i, j] = len(positions) - syn_diff[i, j]
+
+    return {"stop": stop, "syn_ts": syn_ts, "syn_tv": syn_tv,
+            "syn_diff": syn_diff, "nonsyn_diff": nonsyn_diff, "ts": ts, "tv": tv}
+
+
+def encode_codons(cds):
     """
+    Encode a coding sequence as an array of codon indices (see `codon_tables()`),
+    with -1 for the codons with ambiguous bases and the stop codons.
+    """
+    bases = np.frombuffer(cds.upper().replace("U", "T").encode(), dtype=np.uint8)[:len(cds) // 3 * 3]
+    lookup = np.full(256, -1, dtype=np.int16)
+    for value, base in enumerate(CODON_BASES):
+        lookup[ord(base)] = value
+    triplets = lookup[bases].reshape(-1, 3)
+    codons = triplets[:, 0] * 16 + triplets[:, 1] * 4 + triplets[:, 2]
+    codons[(triplets < 0).any(axis=1)] = -1
+    codons[codons >= 0] = np.where(codon_tables()["stop"][codons[codons >= 0]], -1, codons[codons >= 0])
+    return codons.astype(np.int16)
+
+
+def codon_alignment(aligner, prot1, prot2, cds1, cds2):
+    """
+    Align two proteins and back-translate the alignment to their codons, as ParaAT does.
 
-    # Create the 'proc.txt' file to store the number of threads used (required by ParaAT and KaKs Calculator)
-    # file_threads = os.path.join(arg.input, "proc.txt")
-    file_threads = os.path.join(os.getcwd(), ResultsPath, "proc.txt")
-    with open(file_threads, "w") as fh:
-        fh.write(str(arg.numberThreads) + '\n')
+    Returns:
+        tuple: Two arrays with the codon indices of the aligned residues (the gapped columns are left out).
+            They are empty when a protein is, e.g. for a CDS starting with a stop codon: the pair gets no Ks.
+    """
+    prot1, prot2 = prot1.rstrip("*"), prot2.rstrip("*")
+    codons1, codons2 = encode_codons(cds1), encode_codons(cds2)
+    if not prot1 or not prot2:
+        return np.empty(0, dtype=codons1.dtype), np.empty(0, dtype=codons2.dtype)
+    # residues outside the matrix alphabet (e.g. `J` for the ambiguous codon `MTT`) are aligned as `X`;
+    # their codons are ambiguous and not counted anyway
+    outside = re.compile(f"[^{re.escape(''.join(aligner.substitution_matrix.alphabet))}]")
+    prot1, prot2 = outside.sub("X", prot1.upper()), outside.sub("X", prot2.upper())
+    alignment = aligner.align(prot1, prot2)[0]
+    positions1 = np.concatenate([np.arange(start, end) for start, end in alignment.aligned[0]] or [np.empty(0, int)])
+    positions2 = np.concatenate([np.arange(start, end) for start, end in alignment.aligned[1]] or [np.empty(0, int)])
+    # residues without a codon (e.g. a truncated CDS) are left out
+    keep = (positions1 < len(codons1)) & (positions2 < len(codons2))
+    return codons1[positions1[keep]], codons2[positions2[keep]]
+
+
+def jukes_cantor(p):
+    """
+    The Jukes-Cantor correction of a proportion of differences (NaN when saturated).
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(p < 0.75, -0.75 * np.log(1 - 4 / 3 * np.minimum(p, 0.75)), np.nan)
 
-    # Create a dictionary to match genes to orthogroups
-    data = pd.read_csv(ResultsPath + "/Orthogroups/Orthogroups.tsv", sep="\t")
-    data_dict = {}
-    data.fillna('empty', inplace=True)
 
-    for row in data.itertuples(index=False):
-        values = []
-        for i in range(1, len(data.columns)):
-            key = row[0]
-            values.append(row[i].split(', '))
-            data_dict[key] = values
-
-    # a dictionary that contains gene pairs matched to their orthogroup.
-    # TODO questo va cambiato per evitare la run di paraAT
-    dict_match = {}
-    file_out = os.path.join('/tmp/output.txt')
-    with open(file_out, 'w') as output_file:
-        for group_name, group_values in data_dict.items():
-            for genes1, genes2 in combinations(group_values, 2):
-                for gene1 in genes1:
-                    if gene1 == "empty":
-                        break
-                    for gene2 in genes2:
-                        if gene2 == "empty":
-                            break
-
-                        if gene1 < gene2:
-                            gene1, gene2 = gene2, gene1
-
-                        line = f"{gene1}\t{gene2}\n"
-                        output_file.write(line)
-                        # data comes in this format:
-                        #   {"gene1-gene2": "OG"}
-                        dict_match[gene1 + "-" + gene2] = group_name
-
-    kaksfolder = os.path.join(os.getcwd(), 'input', 'results', "KaKs_results")
+def count_ks(codons1, codons2, pair_index, n_pairs, method="NG"):
+    """
+    Compute the synonymous distance (Ks) of a batch of codon alignments at once.
+
+    `NG` is the Nei-Gojobori (1986) counting, with the Jukes-Cantor correction. `YN` weights the transitions
+    of the site counting by the transition/transversion ratio of each pair (kappa, estimated with the Kimura
+    two-parameter model), following the idea of Yang & Nielsen (2000).
+
+    Args:
+        codons1, codons2 (np.ndarray): The aligned codon indices of all the pairs, concatenated (-1 to skip a codon).
+        pair_index (np.ndarray): The pair of each aligned codon.
+        n_pairs (int): The number of pairs.
+        method (str): `NG` or `YN`.
+    Returns:
+        np.ndarray: The Ks of each pair, NaN when it cannot be estimated.
+    """
+    tables = codon_tables()
+    valid = (codons1 >= 0) & (codons2 >= 0)
+    codons1, codons2, pair_index = codons1[valid], codons2[valid], pair_index[valid]
+
+    kappa = np.ones(n_pairs)
+    if method == "YN":
+        sites = 3 * np.bincount(pair_index, minlength=n_pairs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            P = np.bincount(pair_index, tables["ts"][codons1, codons2], minlength=n_pairs) / sites
+            Q = np.bincount(pair_index, tables["tv"][codons1, codons2], minlength=n_pairs) / sites
+            transitions = -0.5 * np.log(1 - 2 * P - Q) + 0.25 * np.log(1 - 2 * Q)
+            transversions = -0.5 * np.log(1 - 2 * Q)
+            estimate = 2 * transitions / transversions
+        kappa = np.where(np.isfinite(estimate) & (estimate > 0), np.minimum(estimate, 100), 1.0)
+
+    # the synonymous sites of each codon: 3 transition and 6 transversion neighbors, transitions weighted by kappa
+    codon_kappa = kappa[pair_index]
+    synonymous = 3 * (codon_kappa * (tables["syn_ts"][codons1] + tables["syn_ts"][codons2]) / 2
+                      + (tables["syn_tv"][codons1] + tables["syn_tv"][codons2]) / 2) / (3 * codon_kappa + 6)
+    synonymous_sites = np.bincount(pair_index, synonymous, minlength=n_pairs)
+    synonymous_differences = np.bincount(pair_index, tables["syn_diff"][codons1, codons2], minlength=n_pairs)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return jukes_cantor(synonymous_differences / synonymous_sites)
+
+
+def init_ks_worker(prot_file, cds_file):
+    """
+    Load the indexes of the collection files once in each worker of the built-in Ks engine.
+    """
+    global KS_SEQUENCES
+    KS_SEQUENCES = (prot_file, load_fasta_index(prot_file), cds_file, load_fasta_index(cds_file))
+
+
+def builtin_ks_batch(info):
+    """
+    Align a batch of gene pairs and compute their Ks (see `count_ks()`). Executed in the workers of `builtin_ks()`.
+
+    Args:
+        info (tuple): The pair keys (see `pair_keys()`), the gene tags of the two genes of each pair and the method.
+    Returns:
+        tuple: The pair keys and their Ks (NaN when it cannot be estimated).
+    """
+    keys, tags1, tags2, method = info
+    prot_file, prot_index, cds_file, cds_index = KS_SEQUENCES
+    names1 = ["gene_" + tag.decode("ascii") for tag in tags1]
+    names2 = ["gene_" + tag.decode("ascii") for tag in tags2]
+    proteins = fetch_sequences(prot_file, names1 + names2, prot_index)
+    cds = fetch_sequences(cds_file, names1 + names2, cds_index)
+
+    aligner = Align.PairwiseAligner(mode="global", open_gap_score=-10, extend_gap_score=-0.5,
+                                    substitution_matrix=substitution_matrices.load("BLOSUM62"))
+    first, second, pair_index = [], [], []
+    for index, (gene1, gene2) in enumerate(zip(names1, names2)):
+        if not all(gene in proteins and gene in cds for gene in (gene1, gene2)):
+            continue
+        codons1, codons2 = codon_alignment(aligner, proteins[gene1], proteins[gene2], cds[gene1], cds[gene2])
+        first.append(codons1)
+        second.append(codons2)
+        pair_index.append(np.full(len(codons1), index, dtype=np.int64))
+
+    if not first:
+        return keys, np.full(len(keys), np.nan)
+    # pairs without sequences have no codon, hence a NaN Ks
+    return keys, count_ks(np.concatenate(first), np.concatenate(second), np.concatenate(pair_index), len(keys), method)
+
+
+def builtin_ks(keys, gene_table, proteinfilefinal, cdsfilefinal, method, threads, kaksfolder):
+    """
+    Compute the Ks of gene pairs in process, instead of ParaAT and one KaKs Calculator process per pair.
+
+    The pairs are aligned on their proteins, back-translated to codons and counted in batches (up to `KS_BATCH_SIZE` pairs)
+    with NumPy (see `count_ks()`), across a process pool. The batches are scheduled by the product of the protein
+    lengths of their pairs (see `schedule_tasks()`), and their timings are written in `kaks_task_timings.tsv`.
+
+    ## Args:
+        keys (np.ndarray): The gene pairs, as keys (see `pair_keys()`).
+        gene_table (GeneTable): The gene table.
+        proteinfilefinal (str): The protein collection file (see `write_collection_file()`).
+        cdsfilefinal (str): The CDS collection file.
+        method (str): `NG` or `YN` (see `count_ks()`).
+        threads (int): The number of processes.
+        kaksfolder (str): The folder for the timings.
+    ## Returns:
+        tuple: The pair keys and their Ks (NaN when it cannot be estimated).
+    """
+    os.makedirs(kaksfolder, exist_ok=True)
+    first, second = split_pair_keys(keys)
+    # smaller batches when there are few pairs, so that all the processes get some
+    size = max(1, min(KS_BATCH_SIZE, -(-len(keys) // (threads * 4))))
+    starts = np.arange(0, len(keys), size)
+
+    # the alignment of a pair grows with the product of the protein lengths
+    lengths = load_fasta_index(proteinfilefinal)
+    gene_lengths = np.array([lengths.get("gene_" + tag.decode("ascii"), (0, 0))[1] for tag in gene_table.tags],
+                            dtype=np.float64)
+    costs = np.add.reduceat(gene_lengths[first] * gene_lengths[second], starts) if len(keys) else np.empty(0)
+    seconds = np.zeros(len(starts))
+
+    key_chunks, ks_chunks = [], []
+    with mp.Pool(threads, initializer=init_ks_worker, initargs=(proteinfilefinal, cdsfilefinal)) as p:
+        tasks = [(builtin_ks_batch, batch,
+                  [(keys[start:start + size], gene_table.tags[first[start:start + size]],
+                    gene_table.tags[second[start:start + size]], method) for start in starts[batch]])
+                 for batch in schedule_tasks(costs, threads)]
+        with tqdm.tqdm(total=len(keys), desc=f"Computing Ks ({method})...") as pbar:
+            for results in p.imap_unordered(run_timed_batch, tasks):
+                for index, (batch_keys, batch_ks), elapsed in results:
+                    key_chunks.append(batch_keys)
+                    ks_chunks.append(batch_ks)
+                    seconds[index] = elapsed
+                    pbar.update(len(batch_keys))
+
+    write_task_timings(os.path.join(kaksfolder, "kaks_task_timings.tsv"),
+                       [f"pairs {start}-{min(start + size, len(keys)) - 1}" for start in starts], costs, seconds)
+    return concat_arrays(key_chunks, np.int64), concat_arrays(ks_chunks, np.float64)
+
+
+def run_kaks_calculator(arg, ResultsPath, pairs_file, proteinfilefinal, cdsfilefinal, file_threads, kaksfolder):
+    """
+    Align the gene pairs with ParaAT and compute their Ks with KaKs Calculator, one process per batch of up to
+    `KAKS_AXT_BATCH_SIZE` alignments (see `write_axt_batches()`).
+
+    ## Args:
+        arg: Program parameters.
+        ResultsPath (str): The path to the Orthofinder results folder.
+        pairs_file (str): The tab-separated gene pairs to align.
+        proteinfilefinal (str): The absolute path to the protein file.
+        cdsfilefinal (str): The absolute path to the CDS file.
+        file_threads (str): The file with the number of threads, read by ParaAT.
+        kaksfolder (str): The folder for ParaAT and KaKs Calculator outputs.
+    ## Returns:
+        list: A list of ['gene1-gene2', 'Ks'] entries.
+    """
 
     # check if there's any .axt filepath from paraAT
 
@@ -645,10 +2075,7 @@ def parseKaKs(arg, ResultsPath, proteinfilefinal, cdsfilefinal):
 
     # else: # run ParaAT in the shell.
     # This will create .axt files from the protein and CDS files
-    proteinfilefinal = os.path.join(os.getcwd(), proteinfilefinal)
-    cdsfilefinal = os.path.join(os.getcwd(), cdsfilefinal)
-
-    runparaAT = PARAAT % (file_out, proteinfilefinal, cdsfilefinal, file_threads, kaksfolder)
+    runparaAT = PARAAT % (pairs_file, proteinfilefinal, cdsfilefinal, file_threads, kaksfolder)
     print(f"Running {runparaAT}...")
 
     run = subprocess.Popen(runparaAT, shell=True, cwd=ResultsPath, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -660,62 +2087,508 @@ def parseKaKs(arg, ResultsPath, proteinfilefinal, cdsfilefinal):
         if filename.endswith('.axt'):
             axtFiles.append(os.path.join(kaksfolder, filename))
 
-    for filename in os.listdir(kaksfolder):
-        if filename.endswith('.kaks'):
-            kaks_filepaths.append(os.path.join(kaksfolder, filename))
+    # the .kaks files of a previous run: one per batch, or one per pair for older runs
+    batch_folder = os.path.join(kaksfolder, "batches")
+    for folder in (kaksfolder, batch_folder):
+        if os.path.isdir(folder):
+            for filename in os.listdir(folder):
+                if filename.endswith('.kaks'):
+                    kaks_filepaths.append(os.path.join(folder, filename))
 
     if kaks_filepaths:
         with mp.Pool(arg.numberThreads) as p:
             for x in tqdm.tqdm(p.imap_unordered(read_kaks_file, kaks_filepaths), total=len(kaks_filepaths),
                                desc="Reading .kaks files..."):
-                var.append(x)  # appends each entry to `var`
+                var.extend(x)  # appends the entries of each file to `var`
+
+    else:  # run 'kaksparallel' function on batches of .axt alignments in parallel with multiprocessing.Pool()
+        # smaller batches when there are few pairs, so that all the processes get some
+        batch_size = max(1, min(KAKS_AXT_BATCH_SIZE, -(-len(axtFiles) // (arg.numberThreads * 4))))
+        axt_batches = write_axt_batches(sorted(axtFiles), batch_folder, batch_size)
 
-    else:  # run 'kaksparallel' function on the .axt files in parallel with multiprocessing.Pool()
+        # the size of an alignment file follows the length of the aligned sequences
+        costs = np.array([os.path.getsize(file) for file in axt_batches], dtype=np.float64)
+        seconds = np.zeros(len(axt_batches))
+        batches = schedule_tasks(costs, arg.numberThreads)
         with mp.Pool(arg.numberThreads) as p:
-            with tqdm.tqdm(total=len(axtFiles), desc="Running KaKs Calculator...") as pbar:
-                for x in p.imap_unordered(kaksparallel, axtFiles):
-                    # x is a list that looks like this:
-                    #   ['seq_(pair?)_name', 'Ks']
+            with tqdm.tqdm(total=len(axt_batches), desc="Running KaKs Calculator...") as pbar:
+                tasks = [(kaksparallel, batch, [axt_batches[index] for index in batch]) for batch in batches]
+                for results in p.imap_unordered(run_timed_batch, tasks):
+                    for index, x, elapsed in results:
+                        # x is a list of entries that look like this:
+                        #   ['seq_(pair?)_name', 'Ks']
 
-                    var.append(x)
+                        var.extend(x)
+                        seconds[index] = elapsed
 
-                    # therefore var will be a list of lists:
-                    #   [
-                    #       ['seq_(pair?)_name1', 'Ks'],
-                    #       ['seq_(pair?)_name2', 'Ks'],
-                    #       ...
-                    #   ]
+                        # therefore var will be a list of lists:
+                        #   [
+                        #       ['seq_(pair?)_name1', 'Ks'],
+                        #       ['seq_(pair?)_name2', 'Ks'],
+                        #       ...
+                        #   ]
 
-                    pbar.update()
+                    pbar.update(len(results))
 
-    # create a 'distances' list with KaKs score and the gene pairs.
-    #   data comes in this format:
-    #   [[gene1, gene2, OG, Ks]]
+        write_task_timings(os.path.join(kaksfolder, "kaks_task_timings.tsv"),
+                           [os.path.basename(file) for file in axt_batches], costs, seconds)
 
-    distances = []
+    return var
 
-    for entry in var:
-        try:
-            OG = dict_match[entry[0]]  # retrieve orthogroup by matching with the seq_pair name
-        except KeyError:
-            continue
-        name1, name2 = entry[0].rsplit("-")  # retrieve the original gene names
 
-        if name1 < name2:
-            name1, name2 = name2, name1
+class PairIndex(NamedTuple):
+    """
+    A compact gene pair -> orthogroup index: the sorted pair keys (see `pair_keys()`) and the orthogroup of each,
+    searched with `np.searchsorted` (see `lookup_pairs()`).
+    """
+    keys: np.ndarray  # int64, sorted
+    og: np.ndarray  # int32, the orthogroup index of each key
+
 
-        dist = entry[1]
-        try:
-            dist = float(dist)
-        except ValueError:
+def pair_keys(gene_1, gene_2):
+    """
+    Encode gene pairs as int64 keys, the greater gene ID in the high 32 bits: a key does not depend on the pair order.
+    """
+    gene_1 = np.asarray(gene_1, dtype=np.int64)
+    gene_2 = np.asarray(gene_2, dtype=np.int64)
+    return (np.maximum(gene_1, gene_2) << 32) | np.minimum(gene_1, gene_2)
+
+
+def split_pair_keys(keys):
+    """
+    Decode pair keys into the two gene IDs, the greater first (see `pair_keys()`).
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys >> 32).astype(np.int32), (keys & 0xFFFFFFFF).astype(np.int32)
+
+
+def lookup_pairs(index, keys):
+    """
+    Find pair keys in a `PairIndex`.
+
+    Returns:
+        np.ndarray: The orthogroup index of each key, -1 for the keys not in the index.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if not len(index.keys):
+        return np.full(len(keys), -1, dtype=np.int32)
+    position = np.minimum(np.searchsorted(index.keys, keys), len(index.keys) - 1)
+    return np.where(index.keys[position] == keys, index.og[position], -1).astype(np.int32)
+
+
+def pair_hash(keys):
+    """
+    A pseudo-random number in [0, 1) for each gene pair, from a hash of its key (splitmix64).
+
+    The background sample of the Ks prefilter is made of the pairs with the smallest numbers (see
+    `background_cutoffs()`), so a pair is in the sample or not whatever the run: the background of a run
+    stays a uniform sample when the Ks of a previous run are reused.
+    """
+    z = np.asarray(keys, dtype=np.int64).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / 2 ** 53
+
+
+def species_pair_codes(gene_1, gene_2, gene_table):
+    """
+    The species pair of gene pairs, as one code: greater species code * number of species + smaller code.
+    """
+    species_1 = gene_table.species[gene_1].astype(np.int64)
+    species_2 = gene_table.species[gene_2].astype(np.int64)
+    return np.maximum(species_1, species_2) * len(gene_table.species_names) + np.minimum(species_1, species_2)
+
+
+def smallest_per_species_pair(arrays, k):
+    """
+    Keep the `k` pairs with the smallest hashes of each species pair.
+
+    Args:
+        arrays (tuple): The species pair codes (see `species_pair_codes()`), the hashes (see `pair_hash()`)
+            and any other arrays of the pairs.
+    Returns:
+        tuple: The same arrays, with only the pairs kept.
+    """
+    codes, hashes = arrays[0], arrays[1]
+    order = np.lexsort((hashes, codes))
+    sorted_codes = codes[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes, side="left")
+    keep = order[rank < k]
+    return tuple(array[keep] for array in arrays)
+
+
+def background_cutoffs(codes, hashes, n_codes, fraction, minimum):
+    """
+    The hash cutoff of the background sample of each species pair: the pairs whose hash (see `pair_hash()`)
+    is at most the cutoff of their species pair are in the sample.
+
+    The cutoff is `fraction`, raised to the `minimum`-th smallest hash of the species pair, so that every
+    species pair has at least `minimum` background pairs (all its pairs if it has fewer).
+
+    Args:
+        codes, hashes (np.ndarray): The species pair codes and the hashes of the `minimum` pairs with the
+            smallest hashes of each species pair, among all the pairs (see `smallest_per_species_pair()`).
+        n_codes (int): The number of species pair codes.
+        fraction (float): The fraction of the pairs in the background sample.
+        minimum (int): The smallest background sample of a species pair.
+    Returns:
+        np.ndarray: The cutoff of each species pair code.
+    """
+    counts = np.bincount(codes, minlength=n_codes)
+    largest = np.zeros(n_codes)
+    np.maximum.at(largest, codes, hashes)
+    return np.where(counts < minimum, 1.0, np.maximum(fraction, largest))
+
+
+def tree_candidates(dist_matrix_tree, quantile, margin):
+    """
+    Select the gene pairs worth a Ks computation from their tree distance: a pair can only be an HGT candidate
+    of both criteria if it is also close in its gene tree.
+
+    Args:
+        dist_matrix_tree (pd.DataFrame): The tree distances (see `parseOrthofinder()`).
+        quantile (float): The quantile of the tree distances of each species pair below which pairs are kept.
+        margin (float): The fraction by which the threshold of each species pair is raised.
+    Returns:
+        np.ndarray: The sorted pair keys of the candidates (see `pair_keys()`).
+    """
+    dist = dist_matrix_tree['dist'].to_numpy(dtype=np.float64)
+    threshold = dist_matrix_tree.groupby('species', observed=True)['dist'].transform('quantile', quantile)
+    keep = dist <= threshold.to_numpy(dtype=np.float64) * (1 + margin)
+    keys = pair_keys(dist_matrix_tree['gene_1'].to_numpy()[keep], dist_matrix_tree['gene_2'].to_numpy()[keep])
+    return np.unique(keys)
+
+
+def concat_arrays(chunks, dtype):
+    """
+    Concatenate array chunks, with an empty array of `dtype` when there are none.
+    """
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+
+def orthogroup_genes(ResultsPath, gene_table):
+    """
+    Read the genes of each orthogroup from `Orthogroups.tsv`, as integer gene IDs.
+
+    Returns:
+        tuple: The orthogroup names, and two arrays with the orthogroup index and the ID of every gene,
+            sorted by orthogroup. Genes missing from the gene table are left out.
+    """
+    data = pd.read_csv(ResultsPath + "/Orthogroups/Orthogroups.tsv", sep="\t", dtype=str)
+    og_names = data.iloc[:, 0].to_list()
+    species_genes = data.iloc[:, 1:].set_axis(np.arange(len(data)), axis=0)
+
+    # one gene per row, indexed by its orthogroup index (the empty cells are dropped)
+    genes = species_genes.stack().dropna().str.split(", ").explode()
+    og_index = genes.index.get_level_values(0).to_numpy(dtype=np.int32)
+    ids = gene_ids(gene_table, genes.to_numpy(dtype=str))
+
+    missing = ids < 0
+    if missing.any():
+        print(f'{missing.sum()} genes of Orthogroups.tsv missing from the gene table were skipped')
+    order = np.argsort(og_index[~missing], kind="stable")
+    return og_names, og_index[~missing][order], ids[~missing][order]
+
+
+def orthogroup_pairs(og_names, og_index, ids, gene_table, allowed, kept_genes=None, chunk_size=PAIR_CHUNK_SIZE):
+    """
+    Enumerate the gene pairs of every orthogroup with array operations, in chunks.
+
+    Args:
+        og_names (list): The orthogroup names.
+        og_index, ids (np.ndarray): The orthogroup index and the ID of every gene, sorted by orthogroup
+            (see `orthogroup_genes()`).
+        gene_table (GeneTable): The gene table.
+        allowed (np.ndarray): The species pairs to compute (see `species_pair_mask()`); same-species pairs never are.
+        kept_genes (dict): The genes kept in the large orthogroups (see `select_large_orthogroups()`).
+        chunk_size (int): The number of pairs after which a chunk is yielded.
+    Yields:
+        tuple: Three arrays: the two gene IDs of each pair, the greater first, and their orthogroup index.
+    """
+    kept_genes = kept_genes or {}
+    first_chunks, second_chunks, og_chunks = [], [], []
+    pending = 0
+
+    bounds = np.flatnonzero(np.diff(og_index)) + 1
+    for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(og_index)]])):
+        if end - start < 2:
             continue
-        row = [name1, name2, OG, dist, "kaks"]
-        distances.append(row)
+        og = og_index[start]
+        genes = ids[start:end]
+        if og_names[og] in kept_genes:
+            genes = genes[np.isin(genes, kept_genes[og_names[og]])]
+
+        species = gene_table.species[genes]
+        first, second = np.triu_indices(len(genes), 1)
+        keep = allowed[species[first], species[second]]
+        first, second = genes[first[keep]], genes[second[keep]]
+
+        first_chunks.append(np.maximum(first, second))
+        second_chunks.append(np.minimum(first, second))
+        og_chunks.append(np.full(len(first), og, dtype=np.int32))
+        pending += len(first)
+        if pending >= chunk_size:
+            yield np.concatenate(first_chunks), np.concatenate(second_chunks), np.concatenate(og_chunks)
+            first_chunks, second_chunks, og_chunks = [], [], []
+            pending = 0
+
+    if pending:
+        yield np.concatenate(first_chunks), np.concatenate(second_chunks), np.concatenate(og_chunks)
+
+
+def kaks_entries_to_arrays(var, gene_table):
+    """
+    Convert the ['gene1-gene2', 'Ks'] entries of KaKs Calculator into pair keys and Ks values (NaN for 'NA').
+    """
+    names = pd.Series([entry[0] for entry in var], dtype=str).str.split("-", n=1, expand=True)
+    if not len(names):
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    gene_1 = gene_ids(gene_table, names[0].to_numpy(dtype=str))
+    gene_2 = gene_ids(gene_table, names[1].to_numpy(dtype=str))
+    ks = pd.to_numeric(pd.Series([entry[1] for entry in var]), errors="coerce").to_numpy(dtype=np.float64)
+    valid = (gene_1 >= 0) & (gene_2 >= 0)
+    return pair_keys(gene_1[valid], gene_2[valid]), ks[valid]
 
-    return distances
 
+def ks_model(engine):
+    """
+    The name of the Ks model of an engine (see `--ksEngine`), part of the Ks cache keys.
+    """
+    return "ParaAT+KaKs_Calculator:MA" if engine == "kaks" else f"builtin:{engine}"
 
-def append_species(entry_list, gene_association):
+
+def cds_digests(cdsfilefinal, genes, gene_table):
+    """
+    Hash the CDS of a set of genes, read from the CDS collection file in batches.
+
+    Returns:
+        dict: The gene IDs mapped to the digest of their CDS; genes without a CDS are left out.
+    """
+    index = load_fasta_index(cdsfilefinal)
+    digests = {}
+    for batch in chunked(np.unique(genes).tolist(), FASTAMOD_BATCH_SIZE):
+        names = ["gene_" + tag.decode("ascii") for tag in gene_table.tags[batch]]
+        cds = fetch_sequences(cdsfilefinal, names, index)
+        digests.update((gene, hashlib.blake2b(cds[name].upper().encode(), digest_size=16).digest())
+                       for gene, name in zip(batch, names) if name in cds)
+    return digests
+
+
+def ks_cache_keys(keys, digests, model):
+    """
+    The Ks cache key of each gene pair: a hash of the CDS of both genes (in a fixed order) and of the model,
+    so that the cached values are found again whatever the gene names, the project or the folder.
+
+    Returns:
+        np.ndarray: The keys, as bytes (None for the pairs with a gene without CDS).
+    """
+    first, second = split_pair_keys(keys)
+    content_keys = np.empty(len(keys), dtype=object)
+    for position, (gene1, gene2) in enumerate(zip(first.tolist(), second.tolist())):
+        if gene1 in digests and gene2 in digests:
+            digest = hashlib.blake2b(model.encode(), digest_size=16)
+            for cds in sorted((digests[gene1], digests[gene2])):
+                digest.update(cds)
+            content_keys[position] = digest.digest()
+    return content_keys
+
+
+def open_ks_cache(cache_file):
+    """
+    Open (or create) the sqlite cache of the Ks values.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    connection = sqlite3.connect(cache_file)
+    connection.execute("CREATE TABLE IF NOT EXISTS ks (key BLOB PRIMARY KEY, ks REAL)")
+    return connection
+
+
+def read_ks_cache(cache, content_keys):
+    """
+    Look the pairs up in the Ks cache.
+
+    Returns:
+        tuple: A boolean mask of the pairs found, and their Ks (NaN for the pairs not found, and for those
+            whose Ks could not be estimated).
+    """
+    cached = {}
+    key_list = list({key for key in content_keys if key is not None})
+    for start in range(0, len(key_list), 500):
+        chunk = key_list[start:start + 500]
+        cached.update(cache.execute(f"SELECT key, ks FROM ks WHERE key IN ({','.join('?' * len(chunk))})", chunk))
+    found = np.array([key in cached for key in content_keys], dtype=bool)
+    ks = np.array([np.nan if cached.get(key) is None else cached[key] for key in content_keys], dtype=np.float64)
+    return found, ks
+
+
+def parseKaKs(arg, ResultsPath, proteinfilefinal, cdsfilefinal, gene_table, previous=None, kaksfolder=None,
+              species_pairs=None, kept_genes=None, candidates=None, background=0.0, cache_file=None,
+              min_background=MIN_BACKGROUND_PAIRS):
+    """
+    A function to combine the gene pairs from the Orthofinder results and the KaKs distances.
+    ## Args:
+        arg: Program parameters. Duh?
+        ResultsPath (str): The path to the Orthofinder results folder.
+        proteinfilefinal (str): The path to the protein file.
+        cdsfilefinal (str): The path to the CDS file.
+        gene_table (GeneTable): The gene table.
+        previous (tuple): Ks values of a previous run, as sorted pair keys and their Ks (see `previous_ks()`).
+            These pairs are not aligned again.
+        kaksfolder (str): The folder for ParaAT and KaKs Calculator outputs. Default is `input/results/KaKs_results`.
+            With `cache_file` and the `kaks` engine, each run writes in a new subfolder.
+        species_pairs (set): Only compute these species pairs (see `parse_species_pairs()`). Default is all pairs.
+        kept_genes (dict): The genes kept in the large orthogroups (see `select_large_orthogroups()`).
+        candidates (np.ndarray): Only compute the Ks of these sorted pair keys (see `tree_candidates()`), and of
+            a background sample of all the pairs. Default is all pairs.
+        background (float): The fraction of the pairs in the background sample (see `background_cutoffs()`).
+        cache_file (str): An sqlite file caching the Ks values by the CDS of the pairs and the model
+            (see `ks_cache_keys()`), looked up before any alignment: it can be shared between projects.
+            Default is no cache.
+        min_background (int): The smallest background sample of a species pair, so that its Ks threshold
+            does not come from the prefiltered pairs only.
+    ## Returns:
+        pd.DataFrame: The gene pairs and their distances (see `pairs_frame()`), with these columns:
+            `gene_1` | `gene_2` | `OG` | `dist` = Ks value | `type` = "kaks" | `species`
+            With `candidates`, a boolean `background` column marks the pairs of the background sample.
+
+    The pairs are enumerated per orthogroup with integer gene IDs, and matched back to their orthogroup
+    with a sorted `PairIndex` instead of a dictionary of gene name strings.
+    """
+
+    # Create the 'proc.txt' file to store the number of threads used (required by ParaAT and KaKs Calculator)
+    # file_threads = os.path.join(arg.input, "proc.txt")
+    file_threads = os.path.join(os.getcwd(), ResultsPath, "proc.txt")
+    with open(file_threads, "w") as fh:
+        fh.write(str(arg.numberThreads) + '\n')
+
+    og_names, og_index, ids = orthogroup_genes(ResultsPath, gene_table)
+    allowed = species_pair_mask(gene_table.species_names, species_pairs)
+
+    key_chunks, og_chunks = [], []  # the pairs to compute
+    reused_keys, reused_og, reused_ks = [], [], []  # the pairs already computed by a previous run
+    n_pairs = 0
+    n_codes = len(gene_table.species_names) ** 2
+    # with the prefilter: the pairs with the smallest hashes of each species pair, among all of them
+    # and among those left out, to complete the background samples that are too small
+    smallest = (np.empty(0, dtype=np.int64), np.empty(0))
+    dropped = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32))
+    for first, second, og in orthogroup_pairs(og_names, og_index, ids, gene_table, allowed, kept_genes):
+        keys = pair_keys(first, second)
+        if candidates is not None:
+            codes, hashes = species_pair_codes(first, second, gene_table), pair_hash(keys)
+            smallest = smallest_per_species_pair((np.concatenate([smallest[0], codes]),
+                                                  np.concatenate([smallest[1], hashes])), min_background)
+
+        if previous is not None and len(previous[0]):
+            previous_keys, previous_values = previous
+            position = np.minimum(np.searchsorted(previous_keys, keys), len(previous_keys) - 1)
+            found = previous_keys[position] == keys
+            reused_keys.append(keys[found])
+            reused_og.append(og[found])
+            reused_ks.append(previous_values[position[found]])
+            keys, og = keys[~found], og[~found]
+            if candidates is not None:
+                codes, hashes = codes[~found], hashes[~found]
+
+        if candidates is not None:
+            # the pairs far apart in their gene tree are only computed in the background sample
+            n_pairs += len(keys)
+            keep = np.isin(keys, candidates) | (hashes <= background)
+            dropped = smallest_per_species_pair(tuple(np.concatenate([kept, new[~keep]]) for kept, new in
+                                                      zip(dropped, (codes, hashes, keys, og))), min_background)
+            keys, og = keys[keep], og[keep]
+
+        key_chunks.append(keys)
+        og_chunks.append(og)
+
+    if candidates is not None:
+        # complete the background samples of the species pairs with few pairs below `background`
+        cutoffs = background_cutoffs(smallest[0], smallest[1], n_codes, background, min_background)
+        extra = dropped[1] <= cutoffs[dropped[0]]
+        key_chunks.append(dropped[2][extra])
+        og_chunks.append(dropped[3][extra])
+
+    keys = concat_arrays(key_chunks, np.int64)
+    order = np.argsort(keys, kind="stable")
+    index = PairIndex(keys[order], concat_arrays(og_chunks, np.int32)[order])
+    reused_keys = concat_arrays(reused_keys, np.int64)
+
+    if previous is not None:
+        print(f"[+] Reusing {len(reused_keys)} Ks values from the previous run, computing {len(index.keys)} new pairs.")
+    if candidates is not None:
+        print(f"[+] Tree distance prefilter: computing the Ks of {len(index.keys)} of {n_pairs} pairs.")
+
+    if kaksfolder is None:
+        kaksfolder = os.path.join(os.getcwd(), 'input', 'results', "KaKs_results")
+    if cache_file and arg.ksEngine == "kaks":
+        # only the pairs missing from the cache are aligned, so the .kaks outputs left in the folder by an earlier
+        # run do not match them: every run gets its own folder (`run_kaks_calculator()` reads all the .kaks there)
+        kaksfolder = os.path.join(kaksfolder, datetime.now().strftime("run_%d-%b-%Y_%H_%M_%S_%f"))
+
+    proteinfilefinal = os.path.join(os.getcwd(), proteinfilefinal)
+    cdsfilefinal = os.path.join(os.getcwd(), cdsfilefinal)
+
+    # the pairs already in the Ks cache are not aligned again
+    pending = index.keys
+    cached_keys, cached_ks = np.empty(0, dtype=np.int64), np.empty(0)
+    if cache_file and len(pending):
+        content_keys = ks_cache_keys(pending, cds_digests(cdsfilefinal, np.concatenate(split_pair_keys(pending)),
+                                                          gene_table), ks_model(arg.ksEngine))
+        cache = open_ks_cache(cache_file)
+        found, values = read_ks_cache(cache, content_keys)
+        cached_keys, cached_ks = pending[found], values[found]
+        pending = pending[~found]
+        print(f"\t{len(cached_keys)} Ks values reused from the cache, {len(pending)} to compute.")
+
+    if not len(pending):
+        computed_keys, computed_ks = np.empty(0, dtype=np.int64), np.empty(0)
+    elif arg.ksEngine == "kaks":
+        # the pairs file of ParaAT, written chunk by chunk
+        file_out = os.path.join('/tmp/output.txt')
+        with open(file_out, 'w') as output_file:
+            for start in range(0, len(pending), PAIR_CHUNK_SIZE):
+                first, second = split_pair_keys(pending[start:start + PAIR_CHUNK_SIZE])
+                names = pd.DataFrame({"gene1": "gene_" + pd.Series(gene_table.tags[first]).str.decode("ascii"),
+                                      "gene2": "gene_" + pd.Series(gene_table.tags[second]).str.decode("ascii")})
+                names.to_csv(output_file, sep="\t", header=False, index=False)
+        var = run_kaks_calculator(arg, ResultsPath, file_out, proteinfilefinal, cdsfilefinal, file_threads, kaksfolder)
+        computed_keys, computed_ks = kaks_entries_to_arrays(var, gene_table)
+    else:  # the built-in engine aligns and counts the pairs in process
+        computed_keys, computed_ks = builtin_ks(pending, gene_table, proteinfilefinal, cdsfilefinal, arg.ksEngine,
+                                                arg.numberThreads, kaksfolder)
+
+    if cache_file and len(index.keys):
+        # store the new values, also those that could not be estimated (NULL), by the content of their pair
+        position = np.searchsorted(index.keys, computed_keys)
+        known = (position < len(index.keys)) & (index.keys[np.minimum(position, len(index.keys) - 1)] == computed_keys)
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO ks VALUES (?, ?)",
+                              [(key, None if np.isnan(ks) else ks)
+                               for key, ks in zip(content_keys[position[known]], computed_ks[known].tolist())
+                               if key is not None])
+        cache.close()
+        computed_keys = np.concatenate([cached_keys, computed_keys])
+        computed_ks = np.concatenate([cached_ks, computed_ks])
+
+    # retrieve the orthogroup of each computed pair; pairs without a Ks value are left out
+    computed_og = lookup_pairs(index, computed_keys)
+    valid = (computed_og >= 0) & np.isfinite(computed_ks)
+
+    keys = np.concatenate([reused_keys, computed_keys[valid]])
+    og = np.concatenate([concat_arrays(reused_og, np.int32), computed_og[valid]])
+    ks = np.concatenate([concat_arrays(reused_ks, np.float64), computed_ks[valid]])
+    gene_1, gene_2 = split_pair_keys(keys)
+
+    matrix = pairs_frame(gene_1, gene_2, pd.Categorical.from_codes(og, categories=og_names), ks, "kaks", gene_table)
+    if candidates is not None:
+        matrix['background'] = (pair_hash(pair_keys(matrix['gene_1'], matrix['gene_2'])) <=
+                                cutoffs[species_pair_codes(matrix['gene_1'].to_numpy(), matrix['gene_2'].to_numpy(),
+                                                           gene_table)])
+    return matrix
+
+
+def append_species(entry_list, gene_table):
     """
     Transform an entry list (a list of rows) into a canonical pd.DataFrame.
     Add to the dataframe the information regarding the species to which the genes examined belong to
@@ -724,40 +2597,74 @@ def append_species(entry_list, gene_association):
     -----
     entry_list: list
         A list of lists containing the gene pairs and their distances.
-    gene_association: dict
-        A dictionary containing the gene names and the species to which they belong.
+    gene_table: GeneTable
+        The gene table, matching the gene tags to their species.
 
     Returns:
     --------
     pd.DataFrame
-        A dataframe containing the gene pairs and their distances, with the species information added.
+        A dataframe containing the gene pairs (as integer gene IDs) and their distances, with the species information added.
+        Pairs of genes from the same species are removed.
     """
 
-    final = []
-    for line in entry_list:
+    matrix = pd.DataFrame(entry_list, columns=["gene_1", "gene_2", "OG", "dist", "type"])
 
-        code1 = line[0].split("_")[-1]
-        code2 = line[1].split("_")[-1]
+    return pairs_frame(gene_ids(gene_table, matrix["gene_1"]), gene_ids(gene_table, matrix["gene_2"]),
+                       pd.Categorical(matrix["OG"]), matrix["dist"].to_numpy(), pd.Categorical(matrix["type"]),
+                       gene_table)
 
-        try:
-            species1 = gene_association[code1]['species']
-            species2 = gene_association[code2]['species']
-        except KeyError:
-            print(f'Gene Code missing from association dictionary: {code1} and {code2}')
-            continue
-        if species1 == species2:
-            continue
-        if species1 < species2:
-            species1, species2 = species2, species1
 
-        row = species1 + '_vs_' + species2
-        line.append(row)
-        final.append(line)
+def pairs_frame(gene_1, gene_2, og, dist, kind, gene_table):
+    """
+    Build the canonical dataframe of gene pairs from columns.
 
-    matrix = pd.DataFrame(final,
-                          columns=["gene_1", "gene_2", "OG", "dist", "type", "species"])
+    Pairs with genes missing from the gene table and pairs of genes from the same species are removed,
+    and every pair is written with the greater gene ID first, whatever produced it.
 
-    return matrix
+    Args:
+        gene_1, gene_2 (np.ndarray): The integer IDs of the genes (-1 for missing genes).
+        og (pd.Categorical): The orthogroup of each pair.
+        dist (np.ndarray): The distance of each pair.
+        kind (str or pd.Categorical): The type of distance ("tree", "kaks").
+        gene_table (GeneTable): The gene table.
+    Returns:
+        pd.DataFrame: `gene_1` | `gene_2` | `OG` | `dist` | `type` | `species`, with categorical
+            `OG`, `type` and `species` (e.g. `spB_vs_spA`, the greater species first).
+    """
+    gene_1 = np.asarray(gene_1, dtype=np.int32)
+    gene_2 = np.asarray(gene_2, dtype=np.int32)
+
+    missing = (gene_1 < 0) | (gene_2 < 0)
+    if missing.any():
+        print(f'{missing.sum()} pairs with gene codes missing from the gene table were skipped')
+
+    species1 = np.where(missing, -1, gene_table.species[gene_1.clip(min=0)])
+    species2 = np.where(missing, -1, gene_table.species[gene_2.clip(min=0)])
+    keep = ~missing & (species1 != species2)
+
+    first = np.maximum(gene_1[keep], gene_2[keep])
+    second = np.minimum(gene_1[keep], gene_2[keep])
+
+    # the species pair is named with the greater species first, e.g. `spB_vs_spA`
+    high = np.maximum(species1[keep], species2[keep]).astype(np.int64)
+    low = np.minimum(species1[keep], species2[keep]).astype(np.int64)
+    n_species = len(gene_table.species_names)
+    labels = [f"{gene_table.species_names[h]}_vs_{gene_table.species_names[l]}"
+              for h in range(n_species) for l in range(n_species)]
+
+    if isinstance(kind, str):
+        kind = pd.Categorical.from_codes(np.zeros(int(keep.sum()), dtype=np.int8), categories=[kind])
+    else:
+        kind = pd.Categorical(kind)[keep]
+
+    return pd.DataFrame({
+        "gene_1": first,
+        "gene_2": second,
+        "OG": pd.Categorical(og)[keep].remove_unused_categories(),
+        "dist": np.asarray(dist)[keep],
+        "type": kind,
+        "species": pd.Categorical.from_codes(high * n_species + low, categories=labels).remove_unused_categories(),
+    })
 
 
 def getMeanDist(comp):
@@ -770,7 +2677,7 @@ def getMeanDist(comp):
     return comp[comp.mean_dist > 0]
 
 
-def getHGT(matrix, gene_association):
+def getHGT(matrix, gene_table):
     """
     Transform a dataframe adding the HGT bool variable; Main function to identify potential HGT events between species.
 
@@ -778,6 +2685,7 @@ def getHGT(matrix, gene_association):
     -----------
     `matrix` : pd.DataFrame
         A list of dataframes containing the gene pairs and their distances. The dataframes will be derived from the outputs of KaKs and OrthoFinder.
+        A dataframe already formatted by `append_species()` is also accepted.
 
     Returns:
     --------
@@ -786,7 +2694,13 @@ def getHGT(matrix, gene_association):
     """
 
     # format the pd.DataFrame from list
-    matrix2 = append_species(matrix, gene_association)
+    if isinstance(matrix, pd.DataFrame):
+        matrix2 = matrix.copy()
+        # pairs are compared across sources with the greater gene ID first (see `pairs_frame()`)
+        swap = matrix2['gene_1'] < matrix2['gene_2']
+        matrix2.loc[swap, ['gene_1', 'gene_2']] = matrix2.loc[swap, ['gene_2', 'gene_1']].to_numpy()
+    else:
+        matrix2 = append_species(matrix, gene_table)
 
     # remove NAs
     # matrix2 = matrix2[matrix2['dist'] != "NA"]
@@ -798,8 +2712,15 @@ def getHGT(matrix, gene_association):
     sp_pairs = matrix2['species'].unique()
 
     for sp in sp_pairs:
-        # get the 5th percentile of the distance.
-        threshold = matrix2[matrix2['species'] == sp]['dist'].quantile(.05)
+        # get the 5th percentile of the distance, on the background sample when the pairs were prefiltered
+        # (see `parseKaKs()`), as the other pairs are biased towards small distances.
+        reference = matrix2[matrix2['species'] == sp]
+        if 'background' in reference.columns:
+            if reference['background'].any():
+                reference = reference[reference['background'] == True]
+            else:
+                print(f"Warning: no background pairs for {sp}, its threshold comes from the prefiltered pairs.")
+        threshold = reference['dist'].quantile(.05)
 
         # set the 'HGT' variable to True if the distance is less than the threshold
         matrix2.loc[matrix2['species'] == sp, 'HGT'] = matrix2['dist'] <= threshold
@@ -807,58 +2728,229 @@ def getHGT(matrix, gene_association):
     return matrix2
 
 
-def get_topology(ResultsPath):
+class SpeciesSplits(NamedTuple):
+    """
+    The species tree as bitsets over the species indices, precomputed once for the `bitset` topology engine.
+    """
+    index: Dict[str, int]  # species name (as in the gene tree leaves) -> species index
+    clusters: frozenset  # the species set of each node of the species tree, with 2 species or more
+
+
+def species_clusters(gene_tree, leaf_species):
+    """
+    The set of species below each node of a tree, as an integer bitset (bit `i` set for the species index `i`).
+
+    Args:
+        gene_tree (GeneTree): The tree.
+        leaf_species (list): The species index of each node, -1 for internal nodes and unknown species.
+    Returns:
+        list: The bitset of each node.
+    """
+    bits = [1 << index if index >= 0 else 0 for index in leaf_species]
+    parent = gene_tree.parent.tolist()
+    for node in range(len(bits) - 1, 0, -1):
+        bits[parent[node]] |= bits[node]
+    return bits
+
+
+def species_splits(species_tree):
+    """
+    Precompute the species clusters of the species tree (see `SpeciesSplits`).
+    """
+    names = [name.replace(".", "_") if name is not None else None for name in species_tree.names]
+    index = {name: i for i, name in enumerate(sorted(name for name in names if name is not None))}
+    bits = species_clusters(species_tree, [index[name] if name is not None else -1 for name in names])
+    return SpeciesSplits(index, frozenset(cluster for cluster in bits if cluster & (cluster - 1)))
+
+
+def bitset_rf(gene_tree, splits):
+    """
+    The Robinson-Foulds distance between a gene tree and the species tree, from their species clusters.
+
+    Each node of the gene tree is reduced to the set of species below it, so the clusters of a multi-copy
+    gene tree are compared as sets: duplications that keep the species relationships do not add to the distance.
+    A gene tree with a multifurcating root is unrooted: both trees are then compared as bipartitions of the
+    species. On single-copy trees, the results are those of ete3 `compare()` (with `unrooted=True` for unrooted trees).
+
+    Args:
+        gene_tree (GeneTree): The gene tree.
+        splits (SpeciesSplits): The species tree clusters.
+    Returns:
+        tuple: The RF distance, the maximum RF distance and the normalized RF distance
+            (NaN if there is no informative cluster).
+    """
+    leaf_species = [splits.index.get(name.split("_gene")[0], -1) if name else -1 for name in gene_tree.names]
+    bits = species_clusters(gene_tree, leaf_species)
+
+    # compare only the species found in both trees
+    common = bits[0]
+    reference = {cluster & common for cluster in splits.clusters}
+    source = set(bits)
+    unrooted = np.count_nonzero(gene_tree.parent == 0) > 2
+    if unrooted:
+        # a bipartition is written as the smaller bitset of its two sides, whichever side holds the root
+        reference = {min(cluster, common ^ cluster) for cluster in reference}
+        source = {min(cluster, common ^ cluster) for cluster in source}
+
+    def informative(cluster):
+        # 2 species or more (on both sides of a bipartition); the root cluster (all the common species) does not count
+        other = common ^ cluster
+        return cluster & (cluster - 1) and other and (not unrooted or other & (other - 1))
+
+    reference = {cluster for cluster in reference if informative(cluster)}
+    source = {cluster for cluster in source if informative(cluster)}
+
+    max_rf = len(reference) + len(source)
+    if max_rf <= 0:
+        return np.nan, max(max_rf, 0), np.nan
+    rf = len(reference ^ source)
+    return float(rf), float(max_rf), rf / max_rf
+
+
+def init_topology_worker(species_tree_file, engine="bitset"):
+    """
+    Build the reference species tree once in each worker of the topology pool: as an ete3 tree, or as
+    its species clusters for the `bitset` engine (see `species_splits()`).
+    """
+    global SPECIES_TREE
+    with open(species_tree_file, "r") as fh:
+        species_tree = parse_newick(fh.read())
+    if engine == "bitset":
+        SPECIES_TREE = species_splits(species_tree)
+        return
+    SPECIES_TREE = ete3_tree(species_tree)
+    for node in SPECIES_TREE.traverse():
+        if node.is_leaf():
+            node.name = node.name.replace(".", "_")
+
+
+def compare_topology(info):
+    """
+    Compare the topology of a gene tree with the species tree (see `init_topology_worker()`).
+
+    Args:
+        info (tuple): The orthogroup name and its gene tree (see `GeneTree`).
+    Returns:
+        tuple: The orthogroup, the Robinson-Foulds distance, the maximum RF distance, the normalized RF distance
+            and the reason of a failed comparison ("" if it succeeded, the distances are then NaN).
+    """
+    og, gene_tree = info
+    if isinstance(SPECIES_TREE, SpeciesSplits):
+        rf, max_rf, norm_rf = bitset_rf(gene_tree, SPECIES_TREE)
+        return og, rf, max_rf, norm_rf, "no informative split" if np.isnan(rf) else ""
+
+    og_tree = ete3_tree(gene_tree)
+    for node in og_tree.traverse():
+        if node.is_leaf():
+            node.name = node.name.split("_gene")[0]
+    try:
+        diff = og_tree.compare(SPECIES_TREE)  # use the 'compare()' function from ete3 to compute the Robinson-Foulds distance
+    except Exception as x:
+        return og, np.nan, np.nan, np.nan, f"{type(x).__name__}: {x}".strip()
+    if diff["rf"] == "NA":  # too few shared leaves for any informative split
+        return og, np.nan, diff["max_rf"], np.nan, "no informative split"
+    return og, diff["rf"], diff["max_rf"], diff["norm_rf"], ""
+
+
+def topology_key(gene_tree, species_hash, engine):
+    """
+    The cache key of a topology comparison: a hash of the gene tree topology and leaf names,
+    the species tree and the engine (branch lengths do not change the result).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{TOPOLOGY_CACHE_VERSION}\n{engine}\n{species_hash}\n".encode())
+    digest.update(gene_tree.parent.tobytes())
+    digest.update("\n".join(name or "" for name in gene_tree.names).encode())
+    return digest.hexdigest()
+
+
+def open_topology_cache(cache_file):
+    """
+    Open (or create) the sqlite cache of the topology comparisons.
+    """
+    connection = sqlite3.connect(cache_file)
+    connection.execute("CREATE TABLE IF NOT EXISTS topology "
+                       "(key TEXT PRIMARY KEY, rf REAL, max_rf REAL, norm_rf REAL, failure TEXT)")
+    return connection
+
+
+def get_topology(ResultsPath, gene_trees, threads, engine="bitset", cache_file=None):
     """
     Parameters
     ----------
     ResultsPath : str
         The path to the Orthofinder results folder.
+    gene_trees : dict
+        The gene trees of the Orthofinder results, already parsed (see `load_gene_trees()`).
+    threads : int
+        The number of processes comparing the trees.
+    engine : str
+        `bitset` (see `bitset_rf()`) or `ete3` (ete3 `compare()`).
+    cache_file : str
+        An sqlite file caching the comparisons by the content of the gene tree and the species tree
+        (see `topology_key()`): only new or modified trees are compared. Default is no cache.
 
     Returns
     ---------
-    list:
-        A list of orthogroups with significantly different topology from that of the average species tree.
+    pd.DataFrame:
+        The comparison of each gene tree with the species tree:
+        `OG` | `rf` | `max_rf` | `norm_rf` | `failure` (why the comparison failed, "" otherwise) | `seconds` | `cached` | `HGT`
+        `HGT` is True for the orthogroups with a topology different from that of the species tree (RF distance
+        greater than 0) and for those that could not be compared.
     """
     # get the species tree as a reference
-    single_tree_folder = os.path.join(ResultsPath, "Gene_Trees/")
     species_tree = os.path.join(ResultsPath, "Species_Tree/SpeciesTree_rooted.txt")
 
-    with open(species_tree, "r") as fh:
-        spRoot_single = fh.read()
-    species_tree_ete = ete3.Tree(spRoot_single)
-    for node in species_tree_ete.traverse():
-        if node.is_leaf():
-            node.name = node.name.replace(".", "_")
-    print(species_tree_ete)
-
-    dict_topology = {}  # a dictionary with OG as key and their 'HGT score' (1 or 0) as value
-    list_keep = []
-
-    for root, dir, files in os.walk(single_tree_folder):
-        for file in files:
-            og = file.split("_")[0]
-            dict_topology[og] = 0
-            file_og = os.path.join(single_tree_folder, file)
-            with open(file_og, "r") as fh:
-                og_single = fh.read()
-                og_tree = ete3.Tree(og_single)
-                for node in og_tree.traverse():
-                    if node.is_leaf():
-                        node.name = node.name.split("_gene")[0]
-                try:
-                    diff = og_tree.compare(
-                        species_tree_ete)  # use the 'compare()' function from ete3 to compute the Robinson-Foulds distance
-                    if diff["rf"] > 0:  # if the distance from the average species tree is greater than 0, store the
-                        list_keep.append(og)
-                        dict_topology[og] = 1
-                except Exception as x:
-                    list_keep.append(og)
-                    dict_topology[og] = 1
-                    continue
-
-    list_uniq = list(set(list_keep))  # remove duplicates from the list of HGT candidate OGs
-
-    return list_uniq
+    rows = []
+    orthogroups = list(gene_trees)
+    if cache_file:
+        with open(species_tree, "rb") as fh:
+            species_hash = hashlib.blake2b(fh.read(), digest_size=16).hexdigest()
+        keys = {og: topology_key(gene_trees[og], species_hash, engine) for og in orthogroups}
+        cache = open_topology_cache(cache_file)
+        cached = {}
+        key_list = list(set(keys.values()))
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start:start + 500]
+            cached.update((key, values) for key, *values in cache.execute(
+                f"SELECT key, rf, max_rf, norm_rf, failure FROM topology WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk))
+        for og in orthogroups:
+            if keys[og] in cached:
+                rf, max_rf, norm_rf, failure = cached[keys[og]]
+                rows.append((og, np.nan if rf is None else rf, np.nan if max_rf is None else max_rf,
+                             np.nan if norm_rf is None else norm_rf, failure, 0.0, True))
+        orthogroups = [og for og in orthogroups if keys[og] not in cached]
+        print(f"\t{len(rows)} topology comparisons reused from the cache, {len(orthogroups)} to compute.")
+
+    costs = np.array([len(gene_trees[og].parent) for og in orthogroups], dtype=np.float64)
+    batches = schedule_tasks(costs, threads)
+
+    computed = []
+    if batches:
+        with mp.Pool(threads, initializer=init_topology_worker, initargs=(species_tree, engine)) as p:
+            tasks = [(compare_topology, batch, [(orthogroups[index], gene_trees[orthogroups[index]]) for index in batch])
+                     for batch in batches]
+            with tqdm.tqdm(total=len(orthogroups), desc="Comparing topologies...") as pbar:
+                for results in p.imap_unordered(run_timed_batch, tasks):
+                    for _, row, elapsed in results:
+                        computed.append(row + (elapsed, False))
+                    pbar.update(len(results))
+
+    if cache_file:
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO topology VALUES (?, ?, ?, ?, ?)",
+                              [(keys[og], None if np.isnan(rf) else rf, None if np.isnan(max_rf) else max_rf,
+                                None if np.isnan(norm_rf) else norm_rf, failure)
+                               for og, rf, max_rf, norm_rf, failure, _, _ in computed])
+        cache.close()
+
+    topology = pd.DataFrame(rows + computed, columns=["OG", "rf", "max_rf", "norm_rf", "failure", "seconds", "cached"])
+    topology = topology.sort_values("OG", ignore_index=True)
+    # if the distance from the average species tree is greater than 0, or the trees cannot be compared, keep the OG
+    topology["HGT"] = (topology["rf"] > 0) | (topology["failure"] != "")
+
+    return topology
 
 
 def vennPlot(kaks_OG_list: list, tree_OG_list: list, topology_OG_list: list):
@@ -904,35 +2996,148 @@ def plotData(df):
     return fig
 
 
-def prepare_input(arg):
+def prepare_input(arg, exclude=()):
     # Prepare the input files, coming in a .gff format
     if arg.gffread:
-        prot_path, prot_all_file, cds_all_file, gene_association_file, irregular_proteins_file = prepare_gff_input(arg)
-        gene_association = {}
-        irregular_proteins = []
-        with open(gene_association_file, 'r') as f:
-            for i in f.readlines():
-                code, name, species = i.split('\t')
-                gene_association[code] = {'id': name.strip(), 'species': species.strip()}
-        with open(irregular_proteins_file, 'r') as f:
-            for i in f.readlines():
-                irregular_proteins.append(i.strip())
+        prot_path, prot_all_file, cds_all_file, gene_association_file, irregular_proteins_file = prepare_gff_input(
+            arg, exclude)
 
     # Prepare the input files, coming in a .fasta genome format
     else:
         prot_path, prot_all_file, cds_all_file, gene_association_file, irregular_proteins_file = prepare_fasta_input(
-            arg)
-        gene_association = {}
-        irregular_proteins = []
-        with open(gene_association_file, 'r') as f:
-            for i in f.readlines():
-                code, name, species = i.split('\t')
-                gene_association[code] = {'id': name.strip(), 'species': species.strip()}
-        with open(irregular_proteins_file, 'r') as f:
-            for i in f.readlines():
-                irregular_proteins.append(i.strip())
+            arg, exclude)
+
+    res_path = os.path.dirname(gene_association_file)
+    write_gene_table(res_path)
+    gene_table = load_gene_table(res_path)
+
+    irregular_proteins = []
+    with open(irregular_proteins_file, 'r') as f:
+        for i in f.readlines():
+            irregular_proteins.append(i.strip())
+
+    return prot_all_file, cds_all_file, prot_path, gene_table, irregular_proteins
+
+
+def add_species(arg):
+    """
+    Incremental mode: add the species of the input directory that are missing from the results of a previous run.
+
+    Only the new species are prepared; their genes are appended to the gene table, so the genes of the
+    previous run keep their integer IDs. OrthoFinder is then run in its add-species mode on the new proteomes.
+
+    Args:
+        arg: program parameters
+    Returns:
+        tuple: The collection files, the prot folder, the gene table, the irregular proteins,
+            the new and the previous OrthoFinder results folders.
+    """
+    res_path = os.path.join(arg.input, "results")
+    previous_results_path = arg.orthofinderResults or last_orthofinder_results(res_path)
+    assert previous_results_path, "Error: no previous OrthoFinder results to add the species to. Use `-OFr`."
+
+    with open(os.path.join(res_path, "gene_table_species.txt"), "r") as fh:
+        previous_species = [line.rstrip("\n") for line in fh]
+
+    prot_all_file, cds_all_file, prot_path, gene_table, irregular_proteins = prepare_input(arg,
+                                                                                           exclude=previous_species)
+    new_species = sorted(set(gene_table.species_names) - set(previous_species))
+    assert new_species, f"Error: no new species in '{arg.input}'; the results already include all of them."
+    print(f"[+] Adding {len(new_species)} species: {', '.join(new_species)}")
+
+    # OrthoFinder wants a folder with the new proteomes only
+    new_prot_path = os.path.join(res_path, datetime.now().strftime("prot_added_%d-%b-%Y_%H_%M_%S"))
+    os.makedirs(new_prot_path)
+    for name in new_species:
+        prot_file = f"{name}_prot_mod.faa_mod.fasta"
+        os.symlink(os.path.abspath(os.path.join(prot_path, prot_file)), os.path.join(new_prot_path, prot_file))
+
+    orthofinder_results_path = run_orthofinder_add(new_prot_path, previous_results_path, arg)
+
+    return (prot_all_file, cds_all_file, prot_path, gene_table, irregular_proteins,
+            orthofinder_results_path, previous_results_path)
+
+
+def read_orthogroups(ResultsPath):
+    """
+    Read the members of every orthogroup from `Orthogroups.tsv`.
+
+    Returns:
+        dict: The orthogroup names mapped to the frozenset of their genes.
+    """
+    data = pd.read_csv(ResultsPath + "/Orthogroups/Orthogroups.tsv", sep="\t", dtype=str)
+    data.fillna('', inplace=True)
+
+    members = {}
+    for row in data.itertuples(index=False):
+        members[row[0]] = frozenset(gene for column in row[1:] for gene in column.split(', ') if gene)
+    return members
+
+
+def unchanged_orthogroups(previous_results_path, orthofinder_results_path):
+    """
+    Find the orthogroups whose members did not change between two OrthoFinder runs:
+    they have no genes of the new species and exactly the same genes as an orthogroup of the previous run.
+
+    Returns:
+        dict: The unchanged orthogroups, as {new OG name: previous OG name}.
+    """
+    previous = {genes: og for og, genes in read_orthogroups(previous_results_path).items()}
+
+    return {og: previous[genes] for og, genes in read_orthogroups(orthofinder_results_path).items()
+            if genes in previous}
+
+
+def reuse_tree_distances(previous_tree, unchanged):
+    """
+    Take the tree distances of the unchanged orthogroups from a previous run, renamed to the new orthogroup names.
+    """
+    renamed = {old: new for new, old in unchanged.items()}
+    reused = previous_tree[previous_tree['OG'].isin(renamed)].copy()
+    reused['OG'] = reused['OG'].map(renamed)
+    return reused
+
+
+def previous_ks(previous_kaks):
+    """
+    Turn the Ks distances of a previous run into sorted pair keys (see `pair_keys()`) and their Ks, as used by `parseKaKs()`.
+    """
+    keys = pair_keys(previous_kaks['gene_1'].to_numpy(), previous_kaks['gene_2'].to_numpy())
+    order = np.argsort(keys, kind="stable")
+    return keys[order], previous_kaks['dist'].to_numpy(dtype=np.float64)[order]
+
+
+def last_orthofinder_results(res_path):
+    """
+    The OrthoFinder results folder used by the last run, as saved by `save_run_state()`; None if unknown.
+    """
+    state_file = os.path.join(res_path, "orthofinder_results.txt")
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, "r") as fh:
+        return fh.read().strip() or None
+
 
-    return prot_all_file, cds_all_file, prot_path, gene_association, irregular_proteins
+def save_run_state(res_path, orthofinder_results_path, dist_matrix_tree, dist_matrix_kaks):
+    """
+    Save what a later incremental run (`--addSpecies`) reuses: the OrthoFinder results folder and the distance tables.
+    """
+    with open(os.path.join(res_path, "orthofinder_results.txt"), "w") as fh:
+        fh.write(os.path.abspath(orthofinder_results_path) + "\n")
+
+    columns = ["gene_1", "gene_2", "OG", "dist", "type", "species"]
+    dist_matrix_tree[columns].to_pickle(os.path.join(res_path, "tree_distances.pkl"))
+    dist_matrix_kaks[columns].to_pickle(os.path.join(res_path, "kaks_distances.pkl"))
+
+
+def load_previous_distances(res_path, kind):
+    """
+    Load the distance table (`kind` is "tree" or "kaks") saved by the previous run.
+    """
+    distances_file = os.path.join(res_path, f"{kind}_distances.pkl")
+    assert os.path.exists(distances_file), \
+        f"Error: '{distances_file}' not found. Incremental runs need the distances saved by a complete previous run."
+    return pd.read_pickle(distances_file)
 
 
 if __name__ == "__main__":
@@ -949,8 +3154,20 @@ if __name__ == "__main__":
         print(f"Folder '{output_folder}' already exists. Wait a second??")
 
     results_path = os.path.join(os.getcwd(), 'input', 'results')
+    unchanged = {}
 
-    if os.path.exists(results_path) and os.listdir(results_path):
+    if arg.addSpecies:
+
+        print("[+] Adding the new species to the results of the previous run...")
+
+        (prot_all_file, cds_all_file, prot_path, gene_table, irregular_proteins,
+         orthofinder_results_path, previous_results_path) = add_species(arg)
+
+        # only the orthogroups that changed get their gene tree read again
+        unchanged = unchanged_orthogroups(previous_results_path, orthofinder_results_path)
+        print(f"[+] {len(unchanged)} orthogroups are unchanged since the previous run.")
+
+    elif os.path.exists(results_path) and os.listdir(results_path):
 
         print(f"[+] Scanning {results_path} for previous runs and results...")
 
@@ -962,20 +3179,22 @@ if __name__ == "__main__":
             gene_association_file = os.path.join(results_path, "gene_association.txt")
             irregular_proteins_file = os.path.join(results_path, "irregular_proteins.txt")
 
+            if not os.path.exists(prot_all_file + ".fai") or not os.path.exists(cds_all_file + ".fai"):
+                # collection files from an older run, written without their index
+                create_collection_file(results_path)
+
         except FileNotFoundError:
             print('[+] Some files are missing, restarting the file preparation pipeline...')
             cmd = ['rm', '-r', results_path]
             subprocess.run(cmd, shell=True)
-            prot_all_file, cds_all_file, prot_path, gene_association, irregular_proteins = prepare_input(arg)
+            prot_all_file, cds_all_file, prot_path, gene_table, irregular_proteins = prepare_input(arg)
 
         else:
-            # create the gene_association dictionary and the irregular_proteins list from files left by the previous run
-            gene_association = {}
+            # load the gene table and the irregular_proteins list from files left by the previous run
+            if not os.path.exists(os.path.join(results_path, "gene_table.npy")):
+                write_gene_table(results_path)
+            gene_table = load_gene_table(results_path)
             irregular_proteins = []
-            with open(gene_association_file, 'r') as f:
-                for i in f.readlines():
-                    code, name, species = i.split('\t')
-                    gene_association[code] = {'id': name, 'species': species}
             with open(irregular_proteins_file, 'r') as f:
                 for i in f.readlines():
                     irregular_proteins.append(i.strip())
@@ -987,27 +3206,68 @@ if __name__ == "__main__":
 
         print("[+] Reading and preparing the input files...")
 
-        prot_all_file, cds_all_file, prot_path, gene_association, irregular_proteins = prepare_input(arg)
+        prot_all_file, cds_all_file, prot_path, gene_table, irregular_proteins = prepare_input(arg)
 
         print("[+] File load and preparation complete; running Orthofinder...")
 
-    if arg.orthofinderResults:
+    if arg.addSpecies:
+        pass  # OrthoFinder already ran in its add-species mode
+    elif arg.orthofinderResults:
         orthofinder_results_path = arg.orthofinderResults
     else:
         orthofinder_results_path = run_orthofinder(prot_path, arg)
 
-    dist_matrix_tree = parseOrthofinder(orthofinder_results_path, arg.numberThreads)
-    dist_matrix_tree = getHGT(dist_matrix_tree, gene_association)
+    species_pairs = parse_species_pairs(arg.speciesPairs)
+
+    # parse every gene tree once, for both the distances and the topologies
+    gene_trees = load_gene_trees(orthofinder_results_path, results_path, arg.numberThreads)
+
+    # reduce the very large orthogroups, reporting the pairs left out
+    kept_genes, large_og_report = select_large_orthogroups(gene_trees, gene_table, arg.maxOGSize, arg.largeOGPolicy,
+                                                           species_pairs)
+    large_og_report.to_csv(os.path.join(output_folder, "large_orthogroups.tsv"), sep="\t", index=False)
+
+    dist_matrix_tree = parseOrthofinder(gene_trees, arg.numberThreads, results_path, skip=unchanged,
+                                        species_pairs=species_pairs, kept_genes=kept_genes)
+    if arg.addSpecies:
+        dist_matrix_tree = pd.concat([dist_matrix_tree,
+                                      reuse_tree_distances(load_previous_distances(results_path, "tree"), unchanged)],
+                                     ignore_index=True)
+    dist_matrix_tree = getHGT(dist_matrix_tree, gene_table)
 
     print("[+] Orthofinder scan completed; running KaKs Calculator...")
 
-    dist_matrix_kaks = parseKaKs(arg, orthofinder_results_path, prot_all_file, cds_all_file)
-    dist_matrix_kaks = getHGT(dist_matrix_kaks, gene_association)
+    # optionally, only the pairs close in their gene tree (and a background sample) get their Ks computed
+    candidates = None
+    if arg.ksPrefilter is not None:
+        candidates = tree_candidates(dist_matrix_tree, arg.ksPrefilter, arg.ksPrefilterMargin)
+    ks_cache = arg.ksCache or os.path.join(results_path, "ks_cache.sqlite")
+
+    if arg.addSpecies:
+        dist_matrix_kaks = parseKaKs(arg, orthofinder_results_path, prot_all_file, cds_all_file, gene_table,
+                                     previous=previous_ks(load_previous_distances(results_path, "kaks")),
+                                     kaksfolder=os.path.join(results_path, current_date.strftime(
+                                         "KaKs_results_added_%d-%b-%Y_%H_%M_%S")),
+                                     species_pairs=species_pairs, kept_genes=kept_genes,
+                                     candidates=candidates, background=arg.ksBackground, cache_file=ks_cache)
+    else:
+        dist_matrix_kaks = parseKaKs(arg, orthofinder_results_path, prot_all_file, cds_all_file, gene_table,
+                                     species_pairs=species_pairs, kept_genes=kept_genes,
+                                     candidates=candidates, background=arg.ksBackground, cache_file=ks_cache)
+    dist_matrix_kaks = getHGT(dist_matrix_kaks, gene_table)
+
+    # keep what a later run needs to add species incrementally
+    save_run_state(results_path, orthofinder_results_path, dist_matrix_tree, dist_matrix_kaks)
 
     print("[+] KaKs Calculator run completed; checking topologies...")
 
     # get the list of orthogroups with significantly different topology from that of the average species tree
-    list_topology = get_topology(orthofinder_results_path)
+    topology = get_topology(orthofinder_results_path, gene_trees, arg.numberThreads, arg.topologyEngine,
+                            cache_file=os.path.join(results_path, "topology_cache.sqlite"))
+    topology.to_csv(os.path.join(output_folder, "topology.tsv"), sep="\t", index=False)
+    list_topology = topology.loc[topology['HGT'], 'OG'].to_list()
+    print(f"\t{len(list_topology)} orthogroups with a topology different from the species tree, "
+          f"{(topology['failure'] != '').sum()} of them could not be compared.")
 
     # Create a Venn diagram of the criteria
     list_kaks = dist_matrix_kaks.loc[dist_matrix_kaks['HGT'] == True, 'OG'].to_list()
@@ -1024,18 +3284,6 @@ if __name__ == "__main__":
     irregular_candidates = list(set([i for i in intersection if i in irregular_proteins]))
     print(f"\tWith {len(irregular_candidates)} of them in the irregular sequences collection.")
 
-    # Go back to the original gene name from the ID introduced in the .gff file
-    match = {}
-    for key, value in gene_association.items():
-        sp_name = value['species'].strip()
-        genID = value['id'].strip()
-        try:
-            genID = genID.split('ID=')[-1].split(";")[0]
-        except:
-            pass
-        mvalue = '_'.join([sp_name, genID])
-        match[f"gene_{key}"] = mvalue
-
     # Create a dataframe suitable for plotting
     import plotly
 
@@ -1064,8 +3312,9 @@ if __name__ == "__main__":
     cmplt['HGT'] = cmplt['HGT_kaks'] + cmplt['HGT_tree'] + cmplt['HGT_topology']
     cmplt.sort_values(by=['HGT'], inplace=True, ascending=False)
 
-    cmplt['gene_1'] = cmplt['gene_1'].map(match)
-    cmplt['gene_2'] = cmplt['gene_2'].map(match)
+    # Go back to the original gene name from the integer gene IDs
+    cmplt['gene_1'] = gene_names(gene_table, cmplt['gene_1'])
+    cmplt['gene_2'] = gene_names(gene_table, cmplt['gene_2'])
 
     with open(os.path.join(output_folder, 'cmplt.tsv'), 'x') as f:
         cmplt.to_csv(f, sep='\t', index=False)